@@ -0,0 +1,253 @@
+"""
+bench.py
+
+Benchmarks for encounter.py's hot paths.
+
+Times loading monster data, generating encounters, save/load round trips
+and battle commands, using synthetic monster data so that results don't
+depend on what is in mdata/. Results are printed as JSON; pass a previous
+run's output with --baseline to flag regressions.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from types import SimpleNamespace
+
+import encounter
+
+# Rows in each synthetic monster data file
+DATA_SIZES = {"small" : 300, "medium" : 2000, "large" : 10000}
+# Encounter generation grid
+PARTY_SIZES = (2, 4, 6)
+PARTY_LEVELS = (1, 5, 10, 20)
+GEN_DIFFICULTIES = ("easy", "deadly")
+# Encounters generated per run, by solver
+SOLVER_CALLS = {"walk" : 100, "dp" : 5}
+# Enemies in each save/load round trip
+SAVE_SIZES = (10, 50, 100, 500)
+# Enemies in each scripted battle
+BATTLE_SIZES = (20, 200)
+# Benchmarks run again until they have taken this long in all, in seconds
+MIN_TIME = 0.1
+
+CRS = [0, 0.125, 0.25, 0.5] + list(range(1, 25)) + [30]
+ENVS = ["Forest", "Cave", "Desert", "Urban", "Swamp", "Arctic"]
+WRI = ["fireres", "coldimmu", "poisonimmu", "poisonedimmu", "charmedimmu",
+       "nonmagicalnonsilveredres", "radiantweak", "bludgeoningres", "acidres"]
+
+def setup_args():
+    """Setup arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[-1])
+    parser.add_argument("--baseline",
+            help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+            help="Slowdown vs. the baseline reported as a regression"
+                 " (default 0.25, i.e. 25%%)")
+    parser.add_argument("--floor", type=float, default=1.0,
+            help="Results faster than this many milliseconds are too noisy"
+                 " to report as regressions (default 1)")
+    parser.add_argument("--output",
+            help="Also write the results to this file")
+    parser.add_argument("--repeat", type=int, default=5,
+            help="Passes over every benchmark; the fastest time is kept")
+    parser.add_argument("--quick", action="store_true",
+            help="Skip the large data file and fewer runs, for a fast check")
+    return parser.parse_args()
+
+def write_data(filename, rows, seed=1):
+    """Write a synthetic monster data file"""
+    rand = random.Random(seed)
+    with open(filename, "w", newline="") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(["Name", "CR", "AC", "HP", "Speeds",
+                         "STR", "DEX", "CON", "INT", "WIS", "CHA", "WRI"] +
+                        [f"Env {env}" for env in ENVS])
+        for i in range(rows):
+            writer.writerow(
+                [f"Monster {i}", rand.choice(CRS), rand.randint(10, 22),
+                 rand.randint(5, 400), "30, fly 60"] +
+                [rand.randint(3, 24) for _ in range(6)] +
+                [", ".join(rand.sample(WRI, rand.randint(0, 3)))] +
+                ["x" if rand.random() < 0.4 else "" for _ in ENVS])
+
+def best_time(func, setup=None):
+    """Fastest run of func(), in seconds
+
+    func() runs until the runs add up to MIN_TIME, so that short
+    benchmarks get several tries. setup() runs untimed before each."""
+    times = list()
+    while sum(times) < MIN_TIME:
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_load(results, tmpdir, sizes):
+    """init_data from CSV (cold) and from the compiled cache (warm)"""
+    for label, rows in sizes.items():
+        filename = os.path.join(tmpdir, f"{label}.csv")
+        write_data(filename, rows)
+        cache = encounter.cache_path(filename)
+
+        def drop_cache():
+            if os.path.exists(cache):
+                os.remove(cache)
+
+        load = lambda: encounter.init_data(filename)
+        results[f"load/{label}/csv"] = best_time(load, setup=drop_cache)
+        results[f"load/{label}/cache"] = best_time(load)
+
+def bench_generate(results):
+    """generate_monsters over a grid of parties and difficulties
+
+    Each entry is the time per encounter, from a fixed seed."""
+    for solver, calls in SOLVER_CALLS.items():
+        args = SimpleNamespace(max_per_group=4, use_zero=False, solver=solver)
+        for size in PARTY_SIZES:
+            for lvl in PARTY_LEVELS:
+                encounter.levels = [lvl] * size
+                for difficulty in GEN_DIFFICULTIES:
+                    def generate():
+                        encounter.seed_streams(0)
+                        for _ in range(calls):
+                            encounter.generate_monsters(
+                                SimpleNamespace(**vars(args)), difficulty,
+                                verbose=False)
+                    key = f"generate/{solver}/{size}x{lvl}/{difficulty}"
+                    results[key] = best_time(generate) / calls
+
+def make_enemies(amt):
+    """A save-able list of amt enemies and four players"""
+    monsters = encounter.index.by_xp
+    enemies = [f"Player {i+1}" for i in range(4)]
+    for i in range(amt):
+        mon = monsters[i * 7 % len(monsters)]
+        enemies.append(encounter.Enemy(mon, f"#{i}"))
+    return enemies
+
+def bench_save(results):
+    """save_game then load_game of one battle"""
+    for amt in SAVE_SIZES:
+        enemies = make_enemies(amt)
+
+        def round_trip():
+            encounter.save_game("bench", enemies, silent=True)
+            encounter.writer.flush()
+            encounter.load_game("bench")
+
+        results[f"save_load/{amt}"] = best_time(round_trip)
+
+def battle_script(amt, rounds=10):
+    """Battle commands for amt enemies, as typed at the prompt"""
+    lines = list()
+    for rnd in range(rounds):
+        for uid in range(1, amt + 1, max(1, amt // 10)):
+            lines.append(f"dmg {uid} 3 fire")
+            lines.append(f"{uid} sav +con+2 12")
+            lines.append(f"hp {uid} 1")
+        lines.append(f"sav 1-{min(amt, 10)} dex 14 6 fire half")
+    return lines
+
+def bench_battle(results):
+    """Scripted dmg/sav commands through loop_game, per command"""
+    for amt in BATTLE_SIZES:
+        script = battle_script(amt)
+        text = "\n".join(["l", "battle"] + script + ["bail"]) + "\n"
+
+        def setup():
+            encounter.save_game("battle", make_enemies(amt), silent=True)
+            encounter.writer.flush()
+            sys.stdin = io.StringIO(text)
+
+        stdin = sys.stdin
+        try:
+            total = best_time(encounter.loop_game, setup=setup)
+        finally:
+            sys.stdin = stdin
+        results[f"battle/{amt}"] = total / len(script)
+
+def compare(results, baseline, tolerance, floor):
+    """Print results next to baseline; return names of regressions
+
+    Results and baselines both under floor seconds are never flagged."""
+    regressions = list()
+    width = max(len(name) for name in results)
+    for name, secs in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name:<{width}}  {secs * 1000:10.3f} ms  (new)", file=sys.stderr)
+            continue
+        ratio = secs / base
+        flag = ""
+        if ratio > 1 + tolerance and max(secs, base) >= floor:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<{width}}  {secs * 1000:10.3f} ms  {ratio:6.2f}x{flag}",
+              file=sys.stderr)
+    return regressions
+
+def main():
+    """Run every benchmark"""
+    args = setup_args()
+    repeat = 3 if args.quick else args.repeat
+    sizes = dict(DATA_SIZES)
+    if args.quick:
+        del sizes["large"]
+
+    # encounter.py reads its settings relative to its own folder
+    os.chdir(os.path.dirname(os.path.abspath(encounter.__file__)))
+    encounter.init_config("settings.txt")
+    encounter.init_thresholds("thresholds.csv")
+    encounter.init_status("status.txt")
+
+    # Whole passes are repeated, rather than each benchmark in turn, so
+    # a slow spell on a busy machine only costs one of a benchmark's runs
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        encounter.SAVE_PATH = os.path.join(tmpdir, "saves")
+        for _ in range(repeat):
+            run = dict()
+            bench_load(run, tmpdir, sizes)
+            encounter.init_data(os.path.join(tmpdir, "medium.csv"))
+            bench_generate(run)
+            bench_save(run)
+            bench_battle(run)
+            encounter.writer.flush()
+            for name, secs in run.items():
+                results[name] = min(secs, results.get(name, secs))
+
+    report = {
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "results" : results
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline, "r") as fin:
+            baseline = json.load(fin)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.floor / 1000)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}",
+                  file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,30 @@ For solo D&D encounters!
 """
 
 import argparse
+import array
+import atexit
+import bisect
+import collections
+import copy
 import csv
+import difflib
+import functools
+import hashlib
+import itertools
+import json
+import math
 import os
+import pickle
 import random
 import re
+import shutil
 import statistics
+import subprocess
 import sys
+import tarfile
+import threading
 
+from concurrent.futures import ProcessPoolExecutor
 from types import SimpleNamespace
 
 if hasattr(re, "acc"):
@@ -46,6 +63,9 @@ Useful commands:
                                     Damage enemy #3 for 12 HP.
                                     Ex: "dmg 4 10 +fire"
                                     Damage enemy #4 with adjusted magical fire damage.
+                                    Ex: "dmg 1,3,5-9 28 fire"
+                                    Damage enemies #1, #3 and #5 to #9 (living
+                                    ones only) with adjusted fire damage.
 
     check <enemy id> <dmg/cond>   - Check whether this enemy has a weakness,
                                     resistance, or immunity to a given
@@ -86,6 +106,15 @@ Useful commands:
                                                        has the higher ability
                                                        score.
 
+    sav <enemy ids> <mods> <dc> [<damage> [type]] [half]
+                               - Roll saving throws for several living
+                                 enemies at once. If damage is given, every
+                                 enemy that fails takes it, and with "half"
+                                 every enemy that saves takes half.
+
+                                 Ex: "sav 1-20 dex 15 28 fire half"
+                                 A fireball against enemies #1 to #20.
+
     mf <enemy id> [m|f] - Refresh the status of an enemy,
                           and optionally change its gender.
 
@@ -108,11 +137,30 @@ Useful commands:
 
     xp   - Print the total XP for this encounter
 
+    sim [battles] - Simulate the rest of this battle many times (10000 by
+                    default) and print how often the party wins. A very
+                    rough guide: monsters are modelled by CR, AC and HP,
+                    and players by level only.
+
     quit - Save the current game to _quit.sav, and exit.
 
     help - You're reading it, silly!
 
 
+Hordes (started with --horde <size>):
+
+    Big groups of one monster are listed on a single line, such as
+    "g1) Goblin ×37, 12 bloodied". Use g1 wherever a list of enemy IDs
+    is accepted to target every member, and g1.5 (or g1.5-9) for
+    single members. dmg and sav only affect living members, and report
+    each horde in a line or two rather than one per member.
+
+    Ex: "dmg g1 8 fire"
+    Damage every goblin in horde g1 with adjusted fire damage.
+    Ex: "g1.5 sav con 12"
+    The fifth goblin performs a Constitution saving throw of DC 12.
+
+
 Less useful commands:
 
     debug - Toggle debug output, including exact enemy HP.
@@ -121,6 +169,11 @@ Less useful commands:
     dead - Toggle whether to list enemies once they have 0 HP.
            Off by default.
 
+    compact - Toggle only listing enemies that changed since the
+              last command. Off by default.
+
+    mem - Print approximate memory used by monster data and enemies.
+
     bail - Exit the program without saving.
 """
 
@@ -130,10 +183,16 @@ DIFFICULTIES = ["easy", "med", "hard", "deadly", "hell"]
 levels = list()
 names = list()
 templates = None
+index = None
 DEBUG = False
 SHOW_HOW = True
 SHOW_SPEED = False
 SHOW_DEAD = False
+COMPACT = False
+# Groups of at least this many identical monsters become a Horde (0: never)
+HORDE_SIZE = 0
+# An enemy ID: "3", or "g1.3" for the third member of horde g1
+ENEMY_ID = r"(?:g\d+\.)?\d+"
 
 PHYS_DMG = [
     "bludgeoning",
@@ -186,6 +245,22 @@ MOD_VALUES = {
     MOD_RESIST : 0.5,
     MOD_VUL : 2
 }
+# Monster attribute holding the bitmask for each modifier
+MOD_FIELDS = {
+    MOD_IMMUNE : "immune",
+    MOD_RESIST : "resist",
+    MOD_VUL : "weak"
+}
+MOD_TYPES = DMG_TYPES + COND_TYPES
+MOD_BITS = {name : 1 << i for i, name in enumerate(MOD_TYPES)}
+# Attack properties, see dmg_flags()
+DMG_PROPERTIES = "+-$@"
+NONMAGICAL_FLAG = 1 << DMG_PROPERTIES.index("-")
+# Modifiers that can affect physical damage
+PHYS_MODS = 0
+for _name in PHYS_DMG + ["magical", "nonmagical",
+        "nonmagicalnonadamantine", "nonmagicalnonsilvered"]:
+    PHYS_MODS |= MOD_BITS[_name]
 
 # Encounter XP (NOT difficulty XP)
 exp = 0
@@ -198,6 +273,8 @@ settings = SimpleNamespace(**{
 # Environments to pull from
 valid_envs = set()
 envs = set()
+# Bit assigned to each environment in Monster.env_mask
+env_bits = dict()
 # Base monster to require (often orcs)
 base_monster = None
 
@@ -233,6 +310,51 @@ cr_to_xp = {
     30 : 155000
 }
 
+# Expected damage per round by CR (DMG 5e pg. 274)
+cr_to_dpr = {
+    0 : 1,
+    0.125 : 3,
+    0.25 : 5,
+    0.5 : 7,
+    1 : 12,
+    2 : 18,
+    3 : 24,
+    4 : 30,
+    5 : 36,
+    6 : 42,
+    7 : 48,
+    8 : 54,
+    9 : 60,
+    10 : 66,
+    11 : 72,
+    12 : 78,
+    13 : 84,
+    14 : 90,
+    15 : 96,
+    16 : 102,
+    17 : 108,
+    18 : 114,
+    19 : 120,
+    20 : 132,
+    21 : 150,
+    22 : 168,
+    23 : 186,
+    24 : 204,
+    30 : 312
+}
+
+# (Highest CR, attack bonus) (DMG 5e pg. 274)
+cr_to_atk = [
+    (2, 3), (3, 4), (4, 5), (7, 6), (10, 7), (15, 8),
+    (16, 9), (20, 10), (23, 11), (26, 12), (29, 13), (30, 14)
+]
+
+# multiplier() is the same for this many counted monsters and up
+SOLVER_COUNT_CAP = 15
+
+# Simulated battles still going after this many rounds are stalemates
+SIM_MAX_ROUNDS = 20
+
 cr_threshold = [
     # Dummy value to offset list
     # so item at [1] corresponds
@@ -248,50 +370,327 @@ cr_threshold = [
     10, 11, 12, 13
 ]
 
+# (HP fraction, (male statuses, female statuses)), by ascending fraction
 STATUSES = list()
+STATUS_FRACS = list()
+GENDER = [
+    ("_hishers", "his", "hers"),
+    ("_hisher", "his", "her"),
+    ("_heshe", "he", "she"),
+    ("_himher", "him", "her")
+]
+# Level: per-player XP thresholds in DIFFICULTIES order
+THRESHOLDS = dict()
 SAVE_PATH = "saves"
+# Journal records kept before autosave writes a full snapshot
+JOURNAL_LIMIT = 50
+# Labels for telling apart enemies of the same kind
+COLORS = ("red", "blue", "green", "orange", "purple", "pink", "yellow")
+NICKNAME_TAGS = list()
+# Separate dice per subsystem, so e.g. an extra saving throw doesn't
+# change the next encounter generated from the same seed
+RNG_STREAMS = ("gen", "init", "save", "cosmetic", "sim")
+rng = SimpleNamespace(**{name : random.Random() for name in RNG_STREAMS})
+# Bump when the pickled Monster layout changes
+CACHE_VERSION = 4
+# Monster fields stored in the cache, followed by its environment names
+CACHE_FIELDS = ("name", "rating", "xp", "ac", "hp", "speed", "abilities", "wri")
+# Monsters per pickle in the cache, so it can be read a bit at a time
+CACHE_CHUNK = 1000
+# Encrypted monster data, unpacked into mdata/ when needed
+DATA_ARCHIVE = "mdata.tgz.asc"
+# Records which archive mdata/ was last unpacked from
+DATA_STAMP = os.path.join("mdata", ".archive")
 
 class Monster:
     """A generic monster template with all static stat info"""
+    __slots__ = ("name", "rating", "xp", "ac", "hp", "speed", "env_mask",
+                 "abilities", "wri", "immune", "resist", "weak", "factors",
+                 "source")
+
     def __init__(self, name, rating, ac, hp, speed, stats, modline):
         self.name = name.strip()
         self.rating = float(rating)
         self.xp = cr_to_xp[self.rating]
         self.ac = int(ac)
         self.hp = int(hp)
-        self.speed = speed
-        self.envs = set()
-        self.dmg_mods = dict()
-        self.cond_mods = dict()
-
-        (self.str, self.dex, self.con, self.int, self.wis, self.cha) = \
-        tuple([int(s) for s in stats])
+        self.speed = sys.intern(speed)
+        self.env_mask = 0
+        # Ability scores in VALID_ABILITIES order
+        self.abilities = bytes([int(s) for s in stats])
+        # Damage modifiers are parsed when first needed, see load_mods()
+        self.wri = sys.intern(modline)
+        self.factors = None
+
+    def load_mods(self):
+        """Parse the WRI column into immune/resist/weak and factors"""
+        # Bitmasks over MOD_TYPES
+        self.immune = 0
+        self.resist = 0
+        self.weak = 0
 
         # Set damage type modifiers
-        line = modline.lower().replace(" ", "")
+        line = self.wri.lower().replace(" ", "")
         mods = line.split(",")
         for moditem in mods:
             MODS_OR = f"{MOD_VUL}|{MOD_IMMUNE}|{MOD_RESIST}"
             if re_search(r"^(.+)(" + MODS_OR + r")$", moditem):
                 name, mod = re.matchobj.groups()
-                if name in DMG_TYPES:
-                    self.dmg_mods[name] = mod
-                elif name in COND_TYPES:
-                    self.cond_mods[name] = mod
+                if name in MOD_BITS:
+                    field = MOD_FIELDS[mod]
+                    setattr(self, field, getattr(self, field) | MOD_BITS[name])
                 else:
                     print(f"Did not recognized {name} in {self.name}")
 
+        # Mark as loaded first, since dmg_factors calls mod()
+        self.factors = dict()
+        self.factors.update(dmg_factors(self))
+
+    def score(self, ability):
+        """Ability score, e.g. score("dex")"""
+        return self.abilities[VALID_ABILITIES.index(ability)]
+
+    def factor(self, dmg_type, flags=0):
+        """Damage multiplier against dmg_type for an attack with flags"""
+        if not dmg_type:
+            return 1
+        if self.factors is None:
+            self.load_mods()
+        if dmg_type in PHYS_DMG:
+            # Physical damage is nonmagical anyway unless "+" is given
+            flags &= ~NONMAGICAL_FLAG
+        else:
+            flags = 0
+        return self.factors.get((dmg_type, flags), 1)
+
+    def mod(self, name):
+        """Modifier (MOD_IMMUNE, etc.) for a damage type or condition"""
+        if self.factors is None:
+            self.load_mods()
+        bit = MOD_BITS[name]
+        for mod, field in MOD_FIELDS.items():
+            if getattr(self, field) & bit:
+                return mod
+        return None
+
+class TemplateIndex:
+    """Monster templates sorted by XP, bucketed by CR, and by name
+
+    monsters can be a generator: templates are indexed as they are read."""
+    def __init__(self, monsters=()):
+        # In data file order
+        self.templates = list()
+        self.by_cr = dict()
+        # The first template wins if names repeat
+        self.by_name = dict()
+        self.by_lower = dict()
+        for mon in monsters:
+            self.add(mon)
+        self.finish()
+
+    def add(self, mon):
+        """Index one more template; call finish() once all are added"""
+        self.templates.append(mon)
+        self.by_cr.setdefault(mon.rating, []).append(mon)
+        self.by_name.setdefault(mon.name, mon)
+        self.by_lower.setdefault(mon.name.lower(), mon)
+
+    def finish(self):
+        """Build the XP-sorted views from the CR buckets"""
+        self.by_cr = dict(sorted(self.by_cr.items()))
+        # XP rises with CR, so this is also sorted by XP
+        self.by_xp = [mon for mons in self.by_cr.values() for mon in mons]
+        self.ratings = [mon.rating for mon in self.by_xp]
+        self.__dict__.pop("lower_names", None)
+
+    @functools.cached_property
+    def lower_names(self):
+        """Sorted lowercase names, built on the first name search"""
+        return sorted(self.by_lower)
+
+    def prefixed(self, prefix):
+        """Templates whose lowercase name starts with prefix"""
+        start = bisect.bisect_left(self.lower_names, prefix)
+        result = []
+        for name in self.lower_names[start:]:
+            if not name.startswith(prefix):
+                break
+            result.append(self.by_lower[name])
+        return result
+
+    def fuzzy(self, name, amt=5):
+        """Closest template names to a lowercase name, best first"""
+        matches = difflib.get_close_matches(name, self.lower_names, amt)
+        return [self.by_lower[match] for match in matches]
+
+    def candidates(self, budget, min_xp, max_adj, max_rating,
+                   use_zero=False, env_mask=0, exclude=()):
+        """Yield templates which, added to budget, add at least min_xp
+        adjusted XP without going over max_adj"""
+        start = 0 if use_zero else bisect.bisect_right(self.ratings, 0)
+        split = bisect.bisect_left(self.ratings, budget.cr_floor)
+        end = bisect.bisect_right(self.ratings, max_rating)
+        # Monsters below the CR floor keep the current multiplier,
+        # the rest bump the count by one
+        spans = (
+            (start, min(split, end), budget.mult),
+            (max(start, split), end, multiplier(budget.amt + 1))
+        )
+        for lo, hi, mult in spans:
+            if lo >= hi:
+                continue
+            lo = bisect.bisect_left(self.by_xp, min_xp, lo, hi,
+                    key=lambda mon: mult * (budget.xp + mon.xp) - budget.adj)
+            hi = bisect.bisect_right(self.by_xp, max_adj, lo, hi,
+                    key=lambda mon: mult * (budget.xp + mon.xp))
+            for mon in self.by_xp[lo:hi]:
+                if env_mask and not mon.env_mask & env_mask:
+                    continue
+                if mon not in exclude:
+                    yield mon
+
+def nickname_source():
+    """Every nickname tag in order: colors, pairs of colors, then the
+    same again with a number"""
+    tags = list(COLORS)
+    for x, c1 in enumerate(COLORS):
+        for c2 in COLORS[x+1:]:
+            tags.append(f"{c1}-{c2}")
+    yield from tags
+    for n in itertools.count(2):
+        for tag in tags:
+            yield f"{tag} {n}"
+
+nickname_stream = nickname_source()
+
+def nickname_tags(amt):
+    """The first amt nickname tags, each generated only once"""
+    while len(NICKNAME_TAGS) < amt:
+        NICKNAME_TAGS.append(next(nickname_stream))
+    return itertools.islice(NICKNAME_TAGS, amt)
+
 class Enemy:
     """A monster instance with dynamic HP and a nickname"""
+    __slots__ = ("template", "nickname", "hp", "sex", "_status")
+
     def __init__(self, template, nickname, hp=None, status=None, sex=None):
         self.template = template
         self.nickname = nickname
         self.hp = int(hp or template.hp)
-        self.sex = sex or random.choice(('m', 'f'))
+        self.sex = sex or rng.cosmetic.choice(('m', 'f'))
+        self._status = status or None
+
+    @classmethod
+    def group(cls, template, amt):
+        """amt new enemies of one template, told apart by color"""
+        sexes = rng.cosmetic.choices(('m', 'f'), k=amt)
+        if amt == 1:
+            return [cls(template, template.name, sex=sexes[0])]
+        return [cls(template, f"{template.name} [{tag}]", sex=sex)
+                for tag, sex in zip(nickname_tags(amt), sexes)]
+
+    @property
+    def status(self):
+        # Picked when first shown, so big groups start quickly
+        if self._status is None:
+            self.refresh_status()
+        return self._status
+
+    @status.setter
+    def status(self, text):
+        self._status = text
+
+    @property
+    def hpinfo(self):
+        return "{}/{} HP".format(self.hp, self.template.hp)
+
+    def refresh_status(self):
+        """Refresh this creature's status text"""
+        status = pick_status(self.hp, self.template.hp, self.sex)
         if status:
             self.status = status
-        else:
+
+class Horde:
+    """Many enemies of one template sharing an initiative slot, kept as
+    parallel per-member arrays rather than an Enemy each"""
+    __slots__ = ("template", "nickname", "hps", "sexes", "statuses")
+
+    def __init__(self, template, amt, hps=None, sexes=None):
+        self.template = template
+        self.nickname = template.name
+        self.hps = array.array("i", hps or [template.hp] * amt)
+        sexes = sexes or "".join(rng.cosmetic.choices("mf", k=len(self.hps)))
+        self.sexes = bytearray(sexes, "ascii")
+        # Picked when first needed, like Enemy.status
+        self.statuses = [None] * len(self.hps)
+
+    def __len__(self):
+        return len(self.hps)
+
+    def members(self):
+        """Every member, as HordeMembers"""
+        return [HordeMember(self, idx) for idx in range(len(self.hps))]
+
+    @property
+    def alive(self):
+        return sum(1 for hp in self.hps if hp > 0)
+
+    @property
+    def hpinfo(self):
+        total = sum(hp for hp in self.hps if hp > 0)
+        return "{}/{} HP".format(total, self.template.hp * len(self.hps))
+
+    def summary(self):
+        """Collapsed description, e.g. "Goblin ×37, 12 bloodied" """
+        half = self.template.hp / 2
+        bloodied = sum(1 for hp in self.hps if 0 < hp <= half)
+        text = f"{self.nickname} ×{self.alive}"
+        if bloodied:
+            text += f", {bloodied} bloodied"
+        return text
+
+class HordeMember:
+    """One member of a Horde, usable wherever an Enemy is"""
+    __slots__ = ("horde", "idx")
+
+    def __init__(self, horde, idx):
+        self.horde = horde
+        self.idx = idx
+
+    @property
+    def template(self):
+        return self.horde.template
+
+    @property
+    def nickname(self):
+        return f"{self.horde.nickname} #{self.idx + 1}"
+
+    @property
+    def hp(self):
+        return self.horde.hps[self.idx]
+
+    @hp.setter
+    def hp(self, value):
+        self.horde.hps[self.idx] = value
+
+    @property
+    def sex(self):
+        return chr(self.horde.sexes[self.idx])
+
+    @sex.setter
+    def sex(self, value):
+        self.horde.sexes[self.idx] = ord(value)
+
+    @property
+    def status(self):
+        if self.horde.statuses[self.idx] is None:
             self.refresh_status()
+        return self.horde.statuses[self.idx] or \
+            ("is dead!" if self.hp <= 0 else "")
+
+    @status.setter
+    def status(self, text):
+        self.horde.statuses[self.idx] = text
 
     @property
     def hpinfo(self):
@@ -299,20 +698,44 @@ class Enemy:
 
     def refresh_status(self):
         """Refresh this creature's status text"""
-        GENDER = [
-            ("_hishers", "his", "hers"),
-            ("_hisher", "his", "her"),
-            ("_heshe", "he", "she"),
-            ("_himher", "him", "her")
-        ]
-        frac = self.hp / self.template.hp
-        for thresh, msgs in STATUSES:
-            if frac > thresh:
-                self.status = random.choice(msgs)
-                idx = int(self.sex == "f") + 1
-                for group in GENDER:
-                    self.status = self.status.replace(group[0], group[idx])
-                break
+        status = pick_status(self.hp, self.template.hp, self.sex)
+        if status:
+            self.status = status
+
+def pick_status(hp, max_hp, sex):
+    """Random status text for a creature on hp of max_hp HP, or None if
+    hp is below every threshold"""
+    # Highest threshold below the fraction left
+    idx = bisect.bisect_left(STATUS_FRACS, hp / max_hp) - 1
+    if idx >= 0:
+        return rng.cosmetic.choice(STATUSES[idx][1][sex == "f"])
+    return None
+
+def seed_streams(seed):
+    """Reseed every random stream from one seed"""
+    for name in RNG_STREAMS:
+        setattr(rng, name, random.Random(f"{seed}:{name}"))
+
+def rng_text(name):
+    """Reseed a random stream from itself and return the new seed, which
+    is all a save file needs to carry on from here"""
+    stream = getattr(rng, name)
+    seed = stream.getrandbits(64)
+    stream.seed(seed)
+    return str(seed)
+
+def restore_rng(name, text):
+    """Restore a random stream saved by rng_text"""
+    getattr(rng, name).seed(int(text))
+
+def seed_range(text):
+    """Parse a seed or an inclusive range of seeds ("10-20")"""
+    match = re.search(r"^(\d+)(?:-(\d+))?$", text)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid seed: {text}")
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    return list(range(first, last + 1))
 
 def setup_args():
     """Setup arguments"""
@@ -322,10 +745,44 @@ def setup_args():
             help="Max amt per group")
     parser.add_argument("--use-zero", action="store_true",
             help="Use 0 CR monsters")
-    parser.add_argument("--monster-data", default="mm",
-            help="The data file with monster information")
+    parser.add_argument("--monster-data", nargs="+", default=["mm"],
+            help="The data files with monster information; if a monster"
+                 " is in more than one, the last file listed wins")
+    parser.add_argument("--solver", choices=["walk", "dp"], default="walk",
+            help="Random walk (default), or sample from every combination"
+                 " that fits the target XP")
+    parser.add_argument("--horde", type=int, default=0, metavar="SIZE",
+            help="Keep groups of at least SIZE identical monsters together"
+                 " as one horde")
+    parser.add_argument("--passphrase-file", metavar="FILE",
+            help=f"Read the passphrase for {DATA_ARCHIVE} from FILE"
+                 " (\"-\" for stdin) instead of asking for it")
+    parser.add_argument("--seed", type=int,
+            help="Seed the dice for a reproducible session"
+                 " (batch mode uses --seeds)")
+
+    batch = parser.add_argument_group("batch mode",
+            "Generate encounters without prompting, one JSON line each")
+    batch.add_argument("--batch", action="store_true",
+            help="Run in batch mode")
+    batch.add_argument("--levels", nargs="+", type=int, metavar="LVL",
+            help="Party levels, e.g. --levels 4 4 3")
+    batch.add_argument("--difficulty", choices=DIFFICULTIES, default="med",
+            help="Encounter difficulty")
+    batch.add_argument("--env", action="append", default=[],
+            help="Restrict to an environment (repeatable)")
+    batch.add_argument("--seeds", nargs="+", type=seed_range, default=[[0]],
+            help="Seeds to generate, e.g. --seeds 1 5 10-20")
+    batch.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+            help="Worker processes")
+    batch.add_argument("--simulate", type=int, default=0, metavar="TRIALS",
+            help="Also simulate each encounter this many times")
 
     args = parser.parse_args()
+    if args.batch and not args.levels:
+        parser.error("--batch requires --levels")
+    if args.levels and any(lvl < 1 or lvl > 20 for lvl in args.levels):
+        parser.error("levels must be 1-20")
     return args
 
 def daily_xp_quota():
@@ -343,87 +800,277 @@ def daily_xp_quota():
     total = sum([xp_per_day[lvl] for lvl in levels])
     return total
 
-def multiply(monster_table, *args):
-    """Apply multiplier to xp based on number of enemies"""
-    monsters = list(args)
-    avg_lvl = int(statistics.mean(levels))
-    for mon, amt in monster_table.items():
-        for i in range(0, amt):
-            monsters.append(mon)
-    if not monsters:
-        return SimpleNamespace(xp=0, adj=0)
-
-    xp = sum([m.xp for m in monsters])
-    amt = len([ m for m in monsters
-                if m.rating >= cr_threshold[avg_lvl] ])
+MULTIPLIERS = [0.5, 1, 1.5, 2, 2.5, 3, 4, 5]
 
+def multiplier(amt):
+    """Return the XP multiplier for amt monsters at or above the CR threshold"""
     if amt <= 1: index = 1
     elif amt == 2: index = 2
     elif amt in range(3, 7): index = 3
     elif amt in range(7, 11): index = 4
     elif amt in range(11, 15): index = 5
     else: index = 6
-    
+
     if len(levels) <= 2:
         index = min(index + 1, 5)
     elif len(levels) >= 6:
         index = max(index - 1, 0)
 
-    multipliers = [0.5, 1, 1.5, 2, 2.5, 3, 4, 5]
-    return SimpleNamespace(xp=xp, adj=multipliers[index] * xp)
+    return MULTIPLIERS[index]
+
+class Budget:
+    """Running encounter XP, answering adjusted-XP queries in O(1)"""
+    def __init__(self):
+        self.xp = 0
+        # Monsters counted towards the multiplier
+        self.amt = 0
+        self.cr_floor = cr_threshold[int(statistics.mean(levels))]
+        self.mult = multiplier(0)
+
+    @property
+    def adj(self):
+        return self.mult * self.xp
+
+    def counts(self, mon):
+        """Whether mon counts towards the multiplier"""
+        return mon.rating >= self.cr_floor
+
+    def adj_with(self, mon, n=1):
+        """Adjusted XP if n more of mon were added"""
+        amt = self.amt + n if self.counts(mon) else self.amt
+        return multiplier(amt) * (self.xp + mon.xp * n)
+
+    def add(self, mon, n=1):
+        """Add n of mon to the encounter"""
+        self.xp += mon.xp * n
+        if self.counts(mon):
+            self.amt += n
+            self.mult = multiplier(self.amt)
+
+def multiply(monster_table, *args):
+    """Apply multiplier to xp based on number of enemies"""
+    budget = Budget()
+    for mon, amt in monster_table.items():
+        budget.add(mon, amt)
+    for mon in args:
+        budget.add(mon)
+    return SimpleNamespace(xp=budget.xp, adj=budget.adj)
+
+@functools.lru_cache(maxsize=None)
+def party_thresholds(party):
+    """Total XP thresholds for a sorted tuple of levels"""
+    totals = [0] * len(DIFFICULTIES)
+    for lvl in party:
+        for i, xp in enumerate(THRESHOLDS[lvl]):
+            totals[i] += xp
+    return tuple(totals)
+
+def monster_attack_bonus(rating):
+    """Typical attack bonus for a CR (DMG 5e pg. 274)"""
+    for max_cr, bonus in cr_to_atk:
+        if rating <= max_cr:
+            return bonus
+    return cr_to_atk[-1][1]
+
+def pc_stats(lvl):
+    """Rough (HP, AC, attack bonus, damage per hit) for a PC of level lvl"""
+    prof = 2 + (lvl - 1) // 4
+    ability = min(5, 3 + (lvl >= 4) + (lvl >= 8))
+    hp = 10 + 7 * (lvl - 1)
+    ac = 16 + (lvl >= 5) + (lvl >= 10)
+    return (hp, ac, prof + ability, 5 + 2 * lvl)
+
+def sim_trials(party, foes, trials, seed):
+    """Fight trials abstract battles between party and foes, each a list
+    of (HP, AC, attack bonus, damage per hit).
+
+    Every round each side attacks once per living member, in a random
+    order per battle. The party focuses the weakest foe, foes pick a
+    random target, and natural 20s deal double damage. Battles against
+    no foes are won in round 0, and battles with no party are lost.
+    Returns (wins, losses, [rounds taken by each win])."""
+    if not foes:
+        return trials, 0, [0] * trials
+    if not party:
+        return 0, trials, list()
+    dice = random.Random(seed)
+    rand = dice.random
+    # Lowest d20 roll that hits each target; a 1 always misses, and a 20
+    # always hits for double damage
+    pc_need = [[min(20, max(2, ac - pc[2])) for hp, ac, bonus, dmg in foes]
+               for pc in party]
+    mon_need = [[min(20, max(2, ac - mon[2])) for hp, ac, bonus, dmg in party]
+                for mon in foes]
+    pc_dmg = [pc[3] for pc in party]
+    mon_dmg = [mon[3] for mon in foes]
+    wins = 0
+    losses = 0
+    rounds_won = list()
+    for _ in range(trials):
+        pc_hp = [pc[0] for pc in party]
+        mon_hp = [mon[0] for mon in foes]
+        # Indexes of the living on each side
+        pcs = list(range(len(party)))
+        mons = list(range(len(foes)))
+        party_first = rand() < 0.5
+        for rnd in range(1, SIM_MAX_ROUNDS + 1):
+            for party_turn in (party_first, not party_first):
+                if party_turn:
+                    # HP only drops, so the weakest foe stays the target
+                    # until it dies
+                    target = min(mons, key=mon_hp.__getitem__)
+                    for pc in pcs:
+                        roll = int(rand() * 20) + 1
+                        if roll < pc_need[pc][target]:
+                            continue
+                        mon_hp[target] -= 2 * pc_dmg[pc] if roll == 20 else pc_dmg[pc]
+                        if mon_hp[target] <= 0:
+                            mons.remove(target)
+                            if not mons:
+                                break
+                            target = min(mons, key=mon_hp.__getitem__)
+                else:
+                    for mon in mons:
+                        target = pcs[int(rand() * len(pcs))]
+                        roll = int(rand() * 20) + 1
+                        if roll < mon_need[mon][target]:
+                            continue
+                        pc_hp[target] -= 2 * mon_dmg[mon] if roll == 20 else mon_dmg[mon]
+                        if pc_hp[target] <= 0:
+                            pcs.remove(target)
+                            if not pcs:
+                                break
+                if not mons or not pcs:
+                    break
+            if not mons:
+                wins += 1
+                rounds_won.append(rnd)
+                break
+            if not pcs:
+                losses += 1
+                break
+    return wins, losses, rounds_won
+
+def simulate(monsters, trials, jobs=1, seed=None):
+    """Simulate battles of the party (levels) against monsters, a list
+    of (Monster, current HP)"""
+    party = [pc_stats(lvl) for lvl in levels]
+    foes = [(hp, mon.ac, monster_attack_bonus(mon.rating), cr_to_dpr[mon.rating])
+            for mon, hp in monsters if hp > 0]
+    if seed is None:
+        seed = rng.sim.getrandbits(32)
+
+    jobs = max(1, min(jobs, trials))
+    sizes = [trials // jobs + (i < trials % jobs) for i in range(jobs)]
+    seeds = [seed + i for i in range(jobs)]
+    run = functools.partial(sim_trials, party, foes)
+    if jobs == 1:
+        results = list(map(run, sizes, seeds))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(run, sizes, seeds))
+
+    rounds = sorted(rnd for wins, losses, rounds in results for rnd in rounds)
+    return SimpleNamespace(
+        trials=trials,
+        wins=sum(result[0] for result in results),
+        losses=sum(result[1] for result in results),
+        rounds=rounds)
+
+def print_simulation(sim):
+    """Print the results of simulate()"""
+    stalemates = sim.trials - sim.wins - sim.losses
+    print(f"Simulated {sim.trials} battles:")
+    print(f"  Party wins:  {100 * sim.wins / sim.trials:.1f}%")
+    print(f"  Party loses: {100 * sim.losses / sim.trials:.1f}%")
+    if stalemates:
+        print(f"  Still going after {SIM_MAX_ROUNDS} rounds: "
+              f"{100 * stalemates / sim.trials:.1f}%")
+    if sim.rounds:
+        print("  Rounds to win: median {}, 90% within {}".format(
+            statistics.median(sim.rounds),
+            sim.rounds[int(0.9 * (len(sim.rounds) - 1))]))
+        counts = collections.Counter(sim.rounds)
+        print("  " + ", ".join(f"{rnd}: {100 * amt / len(sim.rounds):.0f}%"
+                               for rnd, amt in sorted(counts.items())))
+
+def sim_jobs(trials):
+    """Processes worth starting for trials simulated battles"""
+    return max(1, min(os.cpu_count() or 1, trials // 20000))
+
+def calc_all_target_xp():
+    """Get target XP for every difficulty"""
+    return dict(zip(DIFFICULTIES, party_thresholds(tuple(sorted(levels)))))
 
 def calc_target_xp(difficulty, print_all=False):
     """Get target XP from table"""
-    with open("thresholds.csv", "r") as fin:
-        lines = [line.strip() for line in fin.readlines()
-                 if line.strip() and re.match(r"[0-9,]+$", line.strip())]
-
-    targets = {}
-    for line in lines:
-        line = line.split(",")
-        targets[int(line[0])] = line[1:]
+    targets = calc_all_target_xp()
 
     if print_all:
-        for difficulty in DIFFICULTIES:
-            total = 0
-            for lvl in levels:
-                total += int(targets[lvl][DIFFICULTIES.index(difficulty)])
+        for difficulty, total in targets.items():
             print(f"{difficulty}: {total}")
-    else:
-        total = 0
-        for lvl in levels:
-            total += int(targets[lvl][DIFFICULTIES.index(difficulty)])
+        return total
 
-    return total
+    return targets[difficulty]
 
 def ability_to_mod(value):
     """Convert ability score to modifier"""
     return (value - 10) // 2
 
-def find_monster(monsters, name, error=False):
-    """Return first Monster item with name"""
-    all_results = list()
-    for mon in monsters:
-        # Immediately return an exact match
-        if mon.name.lower() == name.lower():
-            return mon
-        if mon.name.lower().startswith(name.lower()):
-            all_results.append(mon)
+def env_mask(names):
+    """Combine environment names into a bitmask"""
+    mask = 0
+    for name in names:
+        mask |= env_bits.get(name, 0)
+    return mask
+
+def sizeof(obj):
+    """Approximate bytes used by a slotted object and its own fields"""
+    size = sys.getsizeof(obj)
+    for field in type(obj).__slots__:
+        value = getattr(obj, field, None)
+        # Templates are shared between enemies, so only count leaf values
+        if isinstance(value, (str, bytes, bytearray, array.array, int, float)):
+            size += sys.getsizeof(value)
+    return size
+
+def memory_report(enemies):
+    """Print approximate memory used by monster data and enemies"""
+    monsters = [sizeof(mon) for mon in templates]
+    foes = [sizeof(mon) for mon in enemies if isinstance(mon, Enemy)]
+    for horde in enemies:
+        if isinstance(horde, Horde):
+            foes.append(sizeof(horde) + sys.getsizeof(horde.statuses))
+    print(f"Templates: {len(monsters)} using ~{sum(monsters) // 1024} KiB")
+    print(f"Enemies:   {len(foes)} using ~{sum(foes) // 1024} KiB")
+    if monsters:
+        print(f"Per template: ~{sum(monsters) // len(monsters)} bytes")
+
+def find_monster(name, error=False, fuzzy=False):
+    """Return Monster with name, or the only one starting with it"""
+    name = name.lower()
+    if name in index.by_lower:
+        return index.by_lower[name]
+    all_results = index.prefixed(name)
     if len(all_results) == 1:
         return all_results[0]
     if len(all_results) > 1:
         print("Found multiple matching monsters:")
-        for mon in sorted(all_results, key=lambda x: x.name.lower()):
+        for mon in all_results:
             print(f"    {mon.name}")
+    elif fuzzy:
+        suggestions = index.fuzzy(name)
+        if suggestions:
+            print("Did you mean:")
+            for mon in suggestions:
+                print(f"    {mon.name}")
     if error and len(all_results) != 1:
         print("ERROR: Could not find", name)
         sys.exit(1)
     return None
 
-def init_data(filename):
-    """Read data"""
-    monsters = []
-
+def read_csv(filename):
+    """Parse monsters from a data file, yielding them one by one"""
     with open(filename, "r") as fin:
         reader = csv.DictReader(fin)
         for line in reader:
@@ -433,16 +1080,240 @@ def init_data(filename):
                 [line['STR'], line['DEX'], line['CON'],
                  line['INT'], line['WIS'], line['CHA']],
                  line['WRI'])
-            envs = set()
-            for k,v in line.items():
-                if k.startswith("Env ") and v == "x":
-                    env = k[4:].lower()
-                    valid_envs.add(env)
-                    monster.envs.add(env)
-            monsters.append(monster)
-
+            register_envs(monster, [k[4:].lower() for k,v in line.items()
+                                    if k.startswith("Env ") and v == "x"])
+            yield monster
+
+def cache_path(filename):
+    """Path of the compiled cache for a data file"""
+    return os.path.splitext(filename)[0] + ".cache"
+
+def file_digest(filename):
+    """SHA-256 of a file's contents"""
+    with open(filename, "rb") as fin:
+        return hashlib.sha256(fin.read()).hexdigest()
+
+def read_cache(filename):
+    """Return a generator of monsters from the compiled cache, or None
+    if it is stale"""
+    try:
+        stat = os.stat(filename)
+        fin = open(cache_path(filename), "rb")
+    except OSError:
+        return None
+    try:
+        header = pickle.load(fin)
+        # A touched but unchanged file is still current
+        current = header["version"] == CACHE_VERSION and (
+            (header["mtime"], header["size"]) == (stat.st_mtime, stat.st_size)
+            or header["sha256"] == file_digest(filename))
+    except Exception:
+        # Unreadable caches are simply rebuilt
+        current = False
+    if not current:
+        fin.close()
+        return None
+    return cache_records(fin)
+
+def cache_records(fin):
+    """Yield monsters from an open cache file, a chunk at a time"""
+    with fin:
+        while True:
+            try:
+                states = pickle.load(fin)
+            except EOFError:
+                return
+            for state in states:
+                monster = Monster.__new__(Monster)
+                for field, value in zip(CACHE_FIELDS, state):
+                    setattr(monster, field, value)
+                monster.factors = None
+                register_envs(monster, state[-1])
+                yield monster
+
+def write_cache(filename, monsters):
+    """Write the compiled cache for a data file"""
+    stat = os.stat(filename)
+    header = {
+        "version" : CACHE_VERSION,
+        "mtime" : stat.st_mtime,
+        "size" : stat.st_size,
+        "sha256" : file_digest(filename)
+    }
+    path = cache_path(filename)
+    try:
+        with open(path + ".tmp", "wb") as fout:
+            pickle.dump(header, fout, pickle.HIGHEST_PROTOCOL)
+            for start in range(0, len(monsters), CACHE_CHUNK):
+                states = [tuple(getattr(mon, field) for field in CACHE_FIELDS)
+                          + (env_names(mon.env_mask),)
+                          for mon in monsters[start:start + CACHE_CHUNK]]
+                pickle.dump(states, fout, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        # Caching is optional, e.g. on a read-only install
+        pass
+
+def register_envs(monster, names):
+    """Add environments to valid_envs and set monster's env_mask"""
+    monster.env_mask = 0
+    for env in names:
+        bit = env_bits.get(env)
+        if bit is None:
+            valid_envs.add(env)
+            bit = env_bits[env] = 1 << len(env_bits)
+        monster.env_mask |= bit
+
+def env_names(mask):
+    """Environment names in a bitmask"""
+    return tuple(env for env, bit in env_bits.items() if mask & bit)
+
+def data_paths(names):
+    """Data file paths for --monster-data names"""
+    return [os.path.join("mdata", name + ".csv") for name in names]
+
+def load_source(filename):
+    """Read one data file, from the compiled cache if it is current
+
+    Monsters are tagged with the file name as their source, and their
+    damage modifiers are only parsed once a battle needs them."""
+    monsters = None
+    records = read_cache(filename)
+    if records is not None:
+        try:
+            monsters = list(records)
+        except Exception:
+            # A damaged cache is simply rebuilt
+            pass
+    if monsters is None:
+        monsters = list(read_csv(filename))
+        write_cache(filename, monsters)
+
+    source = os.path.splitext(os.path.basename(filename))[0]
+    for mon in monsters:
+        mon.source = source
     return monsters
 
+def merge_sources(sources):
+    """Yield monsters from lists in order, dropping any whose name is
+    also in a later list"""
+    winner = dict()
+    for i, monsters in enumerate(sources):
+        for mon in monsters:
+            winner[mon.name] = i
+    for i, monsters in enumerate(sources):
+        for mon in monsters:
+            if winner[mon.name] == i:
+                yield mon
+
+def init_data(*filenames):
+    """Read data files into one index
+
+    A monster in more than one file is taken from the last of them."""
+    global index
+    # Only these files' environments are on offer, even if others were
+    # read before, e.g. to compile their caches
+    valid_envs.clear()
+    env_bits.clear()
+    sources = [load_source(filename) for filename in filenames]
+    index = TemplateIndex(merge_sources(sources))
+    return index.templates
+
+def bootstrap_data(paths, passphrase_file=None):
+    """Unpack DATA_ARCHIVE into mdata/ and compile the caches, unless
+    this archive has been unpacked already
+
+    Without a stamp from an earlier unpack, this only happens if one of
+    the data files in paths is missing."""
+    if not os.path.isfile(DATA_ARCHIVE):
+        return
+    stat = os.stat(DATA_ARCHIVE)
+    try:
+        with open(DATA_STAMP, "r") as fin:
+            stamp = json.load(fin)
+    except (OSError, ValueError):
+        stamp = None
+
+    if stamp is None:
+        if all(os.path.isfile(path) for path in paths):
+            return
+    # A touched but unchanged archive is still current
+    elif ((stamp["mtime"], stamp["size"]) == (stat.st_mtime, stat.st_size)
+          or stamp["sha256"] == file_digest(DATA_ARCHIVE)) \
+            and all(os.path.isfile(path) for path in stamp["files"]):
+        return
+
+    print(f"Unpacking {DATA_ARCHIVE}...", file=sys.stderr)
+    os.makedirs("mdata", exist_ok=True)
+    files = unpack_archive(DATA_ARCHIVE, "mdata", read_passphrase(passphrase_file))
+    for path in files:
+        # Builds the compiled cache next to the CSV
+        load_source(path)
+    stamp = {
+        "mtime" : stat.st_mtime,
+        "size" : stat.st_size,
+        "sha256" : file_digest(DATA_ARCHIVE),
+        "files" : files
+    }
+    with open(DATA_STAMP, "w") as fout:
+        json.dump(stamp, fout)
+
+def read_passphrase(passphrase_file):
+    """Passphrase from ENCOUNTER_PASSPHRASE or passphrase_file, or None
+    to let gpg ask for it"""
+    if "ENCOUNTER_PASSPHRASE" in os.environ:
+        return os.environ["ENCOUNTER_PASSPHRASE"]
+    if passphrase_file == "-":
+        return sys.stdin.readline().rstrip("\n")
+    if passphrase_file:
+        with open(passphrase_file, "r") as fin:
+            return fin.readline().rstrip("\n")
+    return None
+
+def unpack_archive(archive, dest, passphrase=None):
+    """Decrypt archive with gpg and stream the CSV files in the tarball
+    inside into dest; return their paths
+
+    Nothing in dest is replaced unless the whole archive decrypts."""
+    cmd = ["gpg", "--quiet", "--decrypt"]
+    if passphrase is not None:
+        # Send the passphrase down stdin rather than the command line
+        cmd += ["--batch", "--pinentry-mode", "loopback", "--passphrase-fd", "0"]
+    try:
+        proc = subprocess.Popen(cmd + [archive], stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE if passphrase is not None else None)
+    except OSError:
+        print(f"ERROR: gpg is needed to unpack {archive}", file=sys.stderr)
+        sys.exit(1)
+    if passphrase is not None:
+        proc.stdin.write(passphrase.encode() + b"\n")
+        proc.stdin.close()
+
+    files = list()
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|gz") as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if not member.isfile() or not name.endswith(".csv"):
+                    continue
+                path = os.path.join(dest, name)
+                with tar.extractfile(member) as fin, open(path + ".tmp", "wb") as fout:
+                    shutil.copyfileobj(fin, fout)
+                files.append(path)
+        ok = True
+    except (tarfile.TarError, OSError, EOFError):
+        ok = False
+    proc.stdout.close()
+    if proc.wait() != 0 or not ok or not files:
+        for path in files:
+            os.remove(path + ".tmp")
+        print(f"ERROR: Could not unpack {archive}", file=sys.stderr)
+        sys.exit(1)
+
+    for path in files:
+        os.replace(path + ".tmp", path)
+    return files
+
 def manual_monsters():
     """Manually create a monster list"""
     global levels
@@ -469,6 +1340,7 @@ def manual_monsters():
         print("  del   (delete this entry from list)")
         print("  clear (clear all monsters from list - be careful!)")
         print("  xp    (print party's xp info)")
+        print("  sim   (simulate battles against this list)")
         print("  done")
         print()
 
@@ -477,7 +1349,7 @@ def manual_monsters():
 
         if cmd == "set":
             choice = input("Which monster? ").strip()
-            mon = find_monster(templates, choice)
+            mon = find_monster(choice, fuzzy=True)
             if not mon:
                 print("I couldn't find that monster")
                 continue
@@ -499,6 +1371,14 @@ def manual_monsters():
             quota = daily_xp_quota()
             print()
             print("Encounter quota (daily/3):", quota // 3, "XP")
+        elif cmd == "sim":
+            if not monster_count:
+                print("No monsters added! Add a monster first.")
+                continue
+            trials = 10000
+            monsters = [(mon, mon.hp) for mon, amt in monster_count.items()
+                        for i in range(amt)]
+            print_simulation(simulate(monsters, trials, sim_jobs(trials)))
         elif cmd == "done":
             if not monster_count:
                 print("No monsters added! Add a monster first.")
@@ -509,108 +1389,316 @@ def manual_monsters():
 
 def random_monsters(args):
     """Generate a monster list"""
-    next_floor = settings.INIT_FILTER_FLOOR
     difficulty = setup_players()
+    result = generate_monsters(args, difficulty)
+
+    print()
+    for monster, amt in result.items():
+        print("{} x{}".format(monster.name, amt))
+    print()
+
+    global exp
+    exp = multiply(result).xp
+    print(exp, "XP")
+    if DEBUG:
+        target_xp_flr = calc_target_xp(difficulty)
+        print(target_xp_flr, "XP <-- target")
+        print(target_xp_flr * 1.1, "XP <-- target")
+
+    return result
+
+def generate_monsters(args, difficulty, verbose=True):
+    """Pick a monster table for the current party and difficulty"""
+    if args.solver == "dp":
+        return solve_monsters(args, difficulty, verbose=verbose)[0]
+    next_floor = settings.INIT_FILTER_FLOOR
     avg_player_lvl = statistics.mean(levels)
 
-    monster_templates = templates.copy()
+    # Monsters already picked
+    used = set()
     target_xp_flr = calc_target_xp(difficulty)
     target_xp_ceil = target_xp_flr * 1.1
+    mask = env_mask(envs)
 
     result = {}
+    budget = Budget()
     xp_total = 0
     monster_count = 0
     # Adjust minimum xp if no elegible monsters
     min_adj = 0
 
-    while not (target_xp_flr < multiply(result).adj and
-               multiply(result).adj <= target_xp_ceil):
+    while not (target_xp_flr < budget.adj <= target_xp_ceil):
         # Minimum XP for this mon to be considered
         # (Remaining XP) * next_floor
-        min_mon_xp = (target_xp_ceil - multiply(result).adj) * next_floor - min_adj
+        min_mon_xp = (target_xp_ceil - budget.adj) * next_floor - min_adj
         # Add base_monster if provided
         if not result and base_monster:
             winner = base_monster
-            amt = random.randint(2, 8)
-            if target_xp_ceil < winner.xp:
+            amt = rng.gen.randint(2, 8)
+            if target_xp_ceil < winner.xp and verbose:
                 print(f"WARNING: {base_monster.name}s too difficult for this group")
         else:
-            # Populate candidates and choose who's next
-            candidates = []
-            for mon in monster_templates:
-                # XP delta with this mon added
-                mon_xp = multiply(result, mon).adj - multiply(result).adj
-
-                # If mon XP is small enough to fit in remaining XP,
-                # and large enough to meet minimum requirement,
-                # and CR is less than avg player's level,
-                # and check if 0 CR is allowed
-                # and check if envs are restricted
-                if multiply(result, mon).adj <= target_xp_ceil and \
-                   mon_xp >= min_mon_xp and \
-                   mon.rating <= avg_player_lvl and \
-                   (mon.rating > 0 or args.use_zero) and \
-                   bool(not envs or envs.intersection(mon.envs)):
-                    candidates.append(mon)
+            # Candidates fit in the remaining XP, meet the minimum
+            # requirement, are at most the avg player's level,
+            # are 0 CR only if allowed, and match restricted envs
+            candidates = list(index.candidates(
+                budget, min_mon_xp, target_xp_ceil, avg_player_lvl,
+                use_zero=args.use_zero, env_mask=mask, exclude=used))
             # If no available creatures, bail
             if not candidates:
                 if min_mon_xp > 0:
                     min_adj += 100
                     continue
                 elif not args.use_zero:
-                    print("Adding 0 CR monsters to pool")
+                    if verbose:
+                        print("Adding 0 CR monsters to pool")
                     args.use_zero = True
                     min_adj = 0
                     continue
                 else:
-                    print("No more candidates - exiting")
+                    if verbose:
+                        print("No more candidates - exiting")
                     break
             min_adj = 0
-            winner = random.choice(candidates)
-            amt = random.randint(1, args.max_per_group)
+            winner = rng.gen.choice(candidates)
+            amt = rng.gen.randint(1, args.max_per_group)
 
         # Remove chosen monster from further candidacy
-        monster_templates.remove(winner)
+        used.add(winner)
 
         while amt > 0:
             xp_total += winner.xp
             result[winner] = result.get(winner, 0) + 1
+            budget.add(winner)
             amt -= 1
             monster_count += 1
-            if multiply(result, winner).adj > target_xp_ceil:
+            if budget.adj_with(winner) > target_xp_ceil:
                 break
 
         next_floor = settings.NEXT_FILTER_FLOOR
- 
-    print()
-    total = 0
-    count = 0
-    for monster, amt in result.items():
-        print("{} x{}".format(monster.name, amt))
-        total += monster.xp * amt
-        count += amt
-    print()
-
-    global exp
-    exp = multiply(result).xp
-    print(exp, "XP")
-    if DEBUG:
-        print(target_xp_flr, "XP <-- target")
-        print(target_xp_ceil, "XP <-- target")
 
     return result
 
+@functools.lru_cache(maxsize=None)
+def group_polys(templates, max_per_group, max_amt):
+    """Ways to split 0..max_amt monsters between n templates, at most
+    max_per_group each, for every n up to templates.
+
+    Returns a list indexed [n][amt]."""
+    polys = [[1] + [0] * max_amt]
+    for n in range(templates):
+        prev = polys[-1]
+        poly = [0] * (max_amt + 1)
+        for amt in range(max_amt + 1):
+            poly[amt] = sum(prev[amt - k] for k in range(min(amt, max_per_group) + 1))
+        polys.append(poly)
+    return polys
+
+def weighted_pick(options):
+    """Pick from [(item, int weight)] in proportion to weight"""
+    roll = rng.gen.randrange(sum(weight for item, weight in options))
+    for item, weight in options:
+        if roll < weight:
+            return item
+        roll -= weight
+
+def solve_monsters(args, difficulty, top=1, verbose=True):
+    """Pick monster tables by counting every combination that fits
+
+    Combinations are counted with a DP over (raw XP, monsters counted
+    towards the multiplier), one CR at a time. If any land inside the
+    target XP window, one is sampled uniformly; otherwise up to top
+    tables are returned from the combinations closest to the target."""
+    avg_player_lvl = statistics.mean(levels)
+    target_xp_flr = calc_target_xp(difficulty)
+    target_xp_ceil = target_xp_flr * 1.1
+    budget = Budget()
+    mask = env_mask(envs)
+    max_per_group = args.max_per_group
+
+    # Groups too small to matter when full are left out, which keeps the
+    # search small (see NEXT_FILTER_FLOOR)
+    min_xp = target_xp_flr * settings.NEXT_FILTER_FLOOR / max_per_group
+
+    preset = dict()
+    if base_monster:
+        preset[base_monster] = rng.gen.randint(2, 8)
+        if target_xp_ceil < base_monster.xp and verbose:
+            print(f"WARNING: {base_monster.name}s too difficult for this group")
+
+    buckets = list()
+    for rating, mons in sorted(index.by_cr.items()):
+        if rating > avg_player_lvl or (rating == 0 and not args.use_zero):
+            continue
+        mons = [mon for mon in mons if mon not in preset and
+                mon.xp >= min_xp and (not mask or mon.env_mask & mask)]
+        if mons:
+            buckets.append(mons)
+    if not buckets and not preset:
+        if not args.use_zero:
+            if verbose:
+                print("Adding 0 CR monsters to pool")
+            args.use_zero = True
+            return solve_monsters(args, difficulty, top, verbose)
+        if verbose:
+            print("No more candidates - exiting")
+        return [dict()]
+
+    # Work in units of the largest common XP step
+    unit = math.gcd(*[mons[0].xp for mons in buckets], *[mon.xp for mon in preset])
+    max_units = int(target_xp_ceil / multiplier(0) / unit)
+    cap = SOLVER_COUNT_CAP
+
+    # State key: units * (cap + 1) + monsters counted (capped)
+    units = sum(mon.xp * amt for mon, amt in preset.items()) // unit
+    counted = min(cap, sum(amt for mon, amt in preset.items() if budget.counts(mon)))
+    tables = [{units * (cap + 1) + counted : 1}]
+    limits = list()
+    for mons in buckets:
+        step = mons[0].xp // unit
+        counts = budget.counts(mons[0])
+        max_amt = min(len(mons) * max_per_group, max_units // step)
+        limits.append(max_amt)
+        poly = group_polys(len(mons), max_per_group, max_amt)[-1]
+        table = collections.defaultdict(int)
+        for key, ways in tables[-1].items():
+            units, counted = divmod(key, cap + 1)
+            for amt in range(max_amt + 1):
+                new_units = units + amt * step
+                if amt and new_units > max_units:
+                    break
+                new_counted = min(cap, counted + amt) if counts else counted
+                table[new_units * (cap + 1) + new_counted] += ways * poly[amt]
+        tables.append(table)
+
+    def adjusted(key):
+        units, counted = divmod(key, cap + 1)
+        return multiplier(counted) * units * unit
+
+    def backtrack(key):
+        """Sample a monster table from the combinations ending at key"""
+        result = dict(preset)
+        for i in reversed(range(len(buckets))):
+            mons = buckets[i]
+            step = mons[0].xp // unit
+            counts = budget.counts(mons[0])
+            polys = group_polys(len(mons), max_per_group, limits[i])
+            units, counted = divmod(key, cap + 1)
+            options = list()
+            for amt in range(min(limits[i], units // step) + 1):
+                prev_units = units - amt * step
+                if not counts:
+                    prev_counts = [counted]
+                elif counted < cap:
+                    prev_counts = [counted - amt] if amt <= counted else []
+                else:
+                    prev_counts = range(max(0, cap - amt), cap + 1)
+                for prev in prev_counts:
+                    prev_key = prev_units * (cap + 1) + prev
+                    ways = tables[i].get(prev_key, 0) * polys[-1][amt]
+                    if ways:
+                        options.append( ((amt, prev_key), ways) )
+            amt, key = weighted_pick(options)
+
+            # Share amt out between this CR's monsters
+            for j, mon in enumerate(mons):
+                rest = polys[len(mons) - j - 1]
+                share = weighted_pick([(k, rest[amt - k])
+                                       for k in range(min(amt, max_per_group) + 1)
+                                       if rest[amt - k]])
+                if share:
+                    result[mon] = share
+                amt -= share
+        return result
+
+    final = tables[-1]
+    valid = [(key, ways) for key, ways in final.items()
+             if target_xp_flr < adjusted(key) <= target_xp_ceil]
+    if valid:
+        return [backtrack(weighted_pick(valid))]
+    if not args.use_zero:
+        if verbose:
+            print("Adding 0 CR monsters to pool")
+        args.use_zero = True
+        return solve_monsters(args, difficulty, top, verbose)
+
+    if verbose:
+        print("No exact fit - using the closest encounters")
+    target = (target_xp_flr + target_xp_ceil) / 2
+    closest = sorted(final, key=lambda key: abs(adjusted(key) - target))
+    return [backtrack(key) for key in closest[:top]]
+
+def batch_init(args):
+    """Load data for batch generation (once per worker)"""
+    global templates
+    init_config("settings.txt")
+    init_thresholds("thresholds.csv")
+    templates = init_data(*data_paths(args.monster_data))
+    levels[:] = args.levels
+    for env in args.env:
+        if env.lower() not in valid_envs:
+            print("ERROR: unknown environment", env, file=sys.stderr)
+            sys.exit(1)
+        envs.add(env.lower())
+
+def batch_encounter(args, seed):
+    """Generate one encounter and return it as a JSON line"""
+    seed_streams(seed)
+    # generate_monsters may switch on use_zero for this encounter only
+    result = generate_monsters(copy.copy(args), args.difficulty, verbose=False)
+    totals = multiply(result)
+    return json.dumps({
+        "seed" : seed,
+        "levels" : levels,
+        "difficulty" : args.difficulty,
+        "monsters" : {mon.name : amt for mon, amt in result.items()},
+        "xp" : totals.xp,
+        "adjusted_xp" : totals.adj,
+        **batch_simulation(args, result, seed)
+    })
+
+def batch_simulation(args, result, seed):
+    """Simulation summary for a batch encounter, if requested"""
+    if not args.simulate or not result:
+        return {}
+    monsters = [(mon, mon.hp) for mon, amt in result.items() for i in range(amt)]
+    sim = simulate(monsters, args.simulate, seed=seed)
+    return {"simulation" : {
+        "trials" : sim.trials,
+        "win" : sim.wins / sim.trials,
+        "loss" : sim.losses / sim.trials,
+        "median_rounds" : statistics.median(sim.rounds) if sim.rounds else None
+    }}
+
+def run_batch(args):
+    """Stream generated encounters to stdout as JSON lines"""
+    batch_init(args)
+    seeds = [seed for group in args.seeds for seed in group]
+    generate = functools.partial(batch_encounter, args)
+    if args.jobs <= 1:
+        for line in map(generate, seeds):
+            print(line)
+        return
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=batch_init,
+                             initargs=(args,)) as pool:
+        for line in pool.map(generate, seeds, chunksize=64):
+            print(line)
+
 def load_game(filename):
     """Load game from a save file"""
+    writer.flush()
     filename = save_path(filename)
     result = []
+    missing = []
     template = None
     nickname = None
     hp = None
     sex = None
+    rngs = dict()
 
     with open(filename, "r") as fin:
-        lines = [ln.strip() for ln in fin.readlines() if ln.strip()]
+        text = fin.read()
+    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
     for line in lines:
         # Add "Player 1" to list
         if line.startswith("#:"):
@@ -618,7 +1706,9 @@ def load_game(filename):
         # Add enemies
         elif line.startswith("Template: "):
             criteria = line[10:]
-            template = [x for x in templates if x.name == criteria][0]
+            template = index.by_name.get(criteria)
+            if not template and criteria not in missing:
+                missing.append(criteria)
         elif line.startswith("Nickname: "):
             nickname = line[10:]
         elif line.startswith("Sex: "):
@@ -627,23 +1717,46 @@ def load_game(filename):
             hp = line[4:]
         elif line.startswith("Status: "):
             status = line[8:]
-            enemy = Enemy(template, nickname, hp=hp, status=status, sex=sex)
-            result.append(enemy)
+            if template:
+                enemy = Enemy(template, nickname, hp=hp, status=status, sex=sex)
+                result.append(enemy)
+        # Add hordes
+        elif line.startswith("Horde: "):
+            criteria = line[7:]
+            template = index.by_name.get(criteria)
+            if not template and criteria not in missing:
+                missing.append(criteria)
+        elif line.startswith("Sexes: "):
+            sex = line[7:]
+        elif line.startswith("HPs: "):
+            hps = [int(hp) for hp in line[5:].split()]
+            if template:
+                result.append(Horde(template, len(hps), hps=hps, sexes=sex))
 
         # Set XP
         elif line.startswith("XP: "):
             global exp
             exp = int(line[4:])
-
+        # Dice as of this save
+        elif re_search(r"^RNG (\w+): (\d+)$", line):
+            if re.matchobj.group(1) in RNG_STREAMS:
+                rngs[re.matchobj.group(1)] = re.matchobj.group(2)
+
+    if missing:
+        print("ERROR: Monsters in {} not found in data: {}".format(
+            filename, ", ".join(missing)))
+        return None
+    for name, state in rngs.items():
+        restore_rng(name, state)
+    replay_journal(filename, text, result)
     return result
 
-def save_game(filename, enemies, silent=False):
-    """Save game to file"""
-    filename = save_path(filename)
-    if not silent:
-        print("Saving to {}...".format(filename))
+def save_text(enemies):
+    """Serialize a game in save file format"""
     lines = []
     lines.append(f"XP: {exp}\n")
+    for name in RNG_STREAMS:
+        lines.append(f"RNG {name}: {rng_text(name)}\n")
     lines.append("\n")
     for enemy in enemies:
         if isinstance(enemy, Enemy):
@@ -653,10 +1766,163 @@ def save_game(filename, enemies, silent=False):
             lines.append("HP: {}\n".format(enemy.hp))
             lines.append("Status: {}\n".format(enemy.status))
             lines.append("\n")
+        elif isinstance(enemy, Horde):
+            # Statuses are picked again after loading
+            lines.append("Horde: {}\n".format(enemy.template.name))
+            lines.append("Sexes: {}\n".format(enemy.sexes.decode("ascii")))
+            lines.append("HPs: {}\n".format(" ".join(map(str, enemy.hps))))
+            lines.append("\n")
         else:
             lines.append("#:{}\n\n".format(enemy))
-    with open(filename, "w") as fout:
-        fout.writelines(lines)
+    return "".join(lines)
+
+def save_game(filename, enemies, silent=False):
+    """Save game to file"""
+    filename = save_path(filename)
+    writer.write(filename, save_text(enemies))
+    if not silent:
+        print("Saving to {}...".format(filename))
+        writer.flush()
+
+class SaveWriter:
+    """Background thread writing save files off the prompt
+
+    Writes queued while the thread is busy are coalesced: a full write
+    drops earlier pending writes to the same file, and appends are
+    merged into the pending write before them."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = list()
+        self.busy = False
+        self.thread = None
+
+    def write(self, path, text):
+        """Atomically replace path with text"""
+        self.submit("w", path, text)
+
+    def append(self, path, text):
+        """Append text to path"""
+        self.submit("a", path, text)
+
+    def submit(self, mode, path, text):
+        """Queue a write, starting the thread if needed"""
+        with self.cond:
+            if mode == "w":
+                self.pending = [op for op in self.pending if op[1] != path]
+            elif self.pending and self.pending[-1][1] == path:
+                self.pending[-1][2] += text
+                return
+            self.pending.append([mode, path, text])
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            self.cond.notify_all()
+
+    def flush(self):
+        """Wait until everything queued is on disk"""
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+
+    def run(self):
+        """Thread body"""
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                ops, self.pending = self.pending, list()
+                self.busy = True
+            try:
+                for mode, path, text in ops:
+                    self.perform(mode, path, text)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    @staticmethod
+    def perform(mode, path, text):
+        """Carry out one queued write, reporting any failure"""
+        try:
+            if mode == "w":
+                # Never leave a truncated file behind
+                with open(path + ".tmp", "w") as fout:
+                    fout.write(text)
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                os.replace(path + ".tmp", path)
+            else:
+                with open(path, "a") as fout:
+                    fout.write(text)
+        except Exception as err:
+            print(f"\nERROR: Could not write {path}: {err}")
+
+writer = SaveWriter()
+
+class Journal:
+    """Append-only log of enemy changes on top of a save snapshot
+
+    The journal starts with the hash of the snapshot it applies to, so a
+    journal left over from an older snapshot is never replayed."""
+    def __init__(self, name):
+        self.name = name
+        self.base = None
+        self.records = 0
+
+    def snapshot(self, enemies):
+        """Save all enemies and start an empty journal"""
+        text = save_text(enemies)
+        writer.write(save_path(self.name), text)
+        writer.write(journal_path(self.name),
+                     "Snapshot: {}\n".format(text_digest(text)))
+        self.base = enemies
+        self.records = 0
+
+    def record(self, uid, enemy, enemies):
+        """Log the new state of enemy #uid"""
+        # A new game, or a long journal, starts from a fresh snapshot
+        if enemies is not self.base or self.records >= JOURNAL_LIMIT:
+            self.snapshot(enemies)
+            return
+        writer.append(journal_path(self.name),
+                      f"{uid} {enemy.hp} {enemy.sex} {enemy.status}\n")
+        self.records += 1
+
+def replay_journal(filename, text, enemies):
+    """Apply the journal for the save file filename, if it has one"""
+    path = os.path.splitext(filename)[0] + ".jnl"
+    if not os.path.isfile(path):
+        return
+    with open(path, "r") as fin:
+        lines = [ln.rstrip("\n") for ln in fin.readlines()]
+    if not lines or lines[0] != "Snapshot: {}".format(text_digest(text)):
+        return
+
+    foes = [enemy for enemy in enemies if isinstance(enemy, Enemy)]
+    hordes = [horde for horde in enemies if isinstance(horde, Horde)]
+    for line in lines[1:]:
+        fields = line.split(" ", 3)
+        # Skip a record cut short by a crash
+        if len(fields) != 4 or not re.fullmatch(ENEMY_ID, fields[0]):
+            continue
+        uid, hp, sex, status = fields
+        if uid.startswith("g"):
+            gid, idx = uid[1:].split(".")
+            enemy = HordeMember(hordes[int(gid) - 1], int(idx) - 1)
+        else:
+            enemy = foes[int(uid) - 1]
+        enemy.hp = int(hp)
+        enemy.sex = sex
+        enemy.status = status
+
+def text_digest(text):
+    """SHA-256 of a string"""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def journal_path(filename):
+    """Return the journal path for a save name"""
+    return os.path.splitext(save_path(filename))[0] + ".jnl"
 
 def save_path(filename):
     """Initialize and return save path"""
@@ -687,352 +1953,699 @@ def init_enemies(monsters_count):
         else:
             name = f"Player {i+1}"
         roll = input_int(f"What is {name}'s initiative? ", sign=True)
-        roll += random.random()
+        roll += rng.init.random()
         inits.append( (name, roll) )
     for mon in monsters_count:
-        roll = random.randint(1, 20) + ability_to_mod(mon.dex) + random.random()
+        roll = rng.init.randint(1, 20) + ability_to_mod(mon.score("dex")) + rng.init.random()
         inits.append( (mon, roll) )
     inits.sort(key=lambda x: x[1], reverse=True)
-    colors_raw = ["red", "blue", "green", "orange", "purple", "pink", "yellow"]
-    colors = colors_raw.copy()
-    for x, c1 in enumerate(colors_raw):
-        for y, c2 in enumerate(colors_raw):
-            if y > x:
-                colors.append(f"{colors[x]}-{colors[y]}")
 
     for mon, init in inits:
         if mon in monsters_count:
-            count = 0
             amt = monsters_count[mon]
-            for i in range(amt):
-                nickname = mon.name
-                if amt > 1:
-                    nickname += f" [{colors[i]}]"
-                enemies.append(Enemy(mon, nickname))
-                count += 1
+            if HORDE_SIZE and amt >= HORDE_SIZE:
+                enemies.append(Horde(mon, amt))
+            else:
+                enemies.extend(Enemy.group(mon, amt))
         else:
             enemies.append(mon)
 
     return enemies
 
-def loop_game():
-    """Play the game!"""
-    def autosave(enemies):
-        save_game("_auto", enemies, silent=True)
-    global DEBUG
-    global SHOW_HOW
-    global SHOW_SPEED
-    global SHOW_DEAD
+class Game:
+    """State shared by the battle command handlers"""
+    def __init__(self):
+        self.enemies = list()
+        # Enemy ID -> Enemy, and back (horde IDs are "g1", "g2", ...)
+        self.select = dict()
+        self.hordes = dict()
+        self.uids = dict()
+        # Rows last drawn, keyed by enemy or player
+        self.frame = dict()
+        self.journal = Journal("_auto")
+
+    def start(self, enemies):
+        """Switch to a new list of enemies and players"""
+        self.enemies = enemies
+        self.select = dict()
+        self.hordes = dict()
+        self.uids = dict()
+        self.frame = dict()
+        for mon in enemies:
+            if isinstance(mon, Enemy):
+                uid = len(self.select) + 1
+                self.select[uid] = mon
+                self.uids[mon] = uid
+            elif isinstance(mon, Horde):
+                gid = len(self.hordes) + 1
+                self.hordes[gid] = mon
+                self.uids[mon] = f"g{gid}"
+
+    def enemy(self, uid):
+        """Return enemy #uid ("3" or "g1.3"), or None if there isn't one"""
+        match = re.fullmatch(r"g(\d+)\.(\d+)", str(uid))
+        if match:
+            horde = self.hordes.get(int(match.group(1)))
+            idx = int(match.group(2)) - 1
+            if horde and 0 <= idx < len(horde):
+                return HordeMember(horde, idx)
+        elif str(uid).isdigit() and int(uid) in self.select:
+            return self.select[int(uid)]
+        print("Enemy #{} does not exist!".format(uid))
+        return None
 
-    enemies = dict()
-    select = dict()
-    prev_cmd = None
+    def horde_members(self):
+        """[(uid, HordeMember)] for every horde member"""
+        return [(f"g{gid}.{member.idx + 1}", member)
+                for gid, horde in self.hordes.items()
+                for member in horde.members()]
+
+    def targets(self, text, living_only=False):
+        """Return [(uid, enemy)] for an ID list like "1,3,5-9,g1,g2.4-6"
+
+        A bare horde ID ("g1") stands for all its members. With
+        living_only, dead enemies are skipped when more than one enemy
+        is targeted."""
+        uids = parse_ids(text)
+        if not uids:
+            print("Could not read enemy IDs:", text)
+            return []
+        expanded = list()
+        for uid in uids:
+            if isinstance(uid, str) and "." not in uid:
+                horde = self.hordes.get(int(uid[1:]))
+                if not horde:
+                    print("Horde {} does not exist!".format(uid))
+                    return []
+                expanded.extend(f"{uid}.{idx + 1}" for idx in range(len(horde)))
+            else:
+                expanded.append(uid)
+        result = list()
+        for uid in expanded:
+            enemy = self.enemy(uid)
+            if not enemy:
+                return []
+            if not living_only or len(expanded) == 1 or enemy.hp > 0:
+                result.append( (uid, enemy) )
+        return result
+
+# Dispatch key: [(compiled pattern, handler)]
+COMMANDS = dict()
+
+def command(*names, pattern=None):
+    """Register a battle command handler
+
+    The handler is called as handler(game, match) for input whose
+    dispatch key (see command_key) is one of names and which matches
+    pattern, by default just the name itself. A true return value ends
+    the game."""
+    regex = re.compile(pattern or r"^(?:{})$".format("|".join(names)))
+    def register(handler):
+        for name in names:
+            COMMANDS.setdefault(name, []).append((regex, handler))
+        return handler
+    return register
+
+def command_key(choice):
+    """Return the first word of a command, or the second for
+    commands of the form "<enemy id> <command> ..." """
+    tokens = choice.split(None, 2)
+    if len(tokens) > 1 and re.fullmatch(ENEMY_ID, tokens[0]):
+        return tokens[1]
+    return tokens[0]
+
+def run_command(game, choice):
+    """Run one command; return True if the game should end"""
+    for regex, handler in COMMANDS.get(command_key(choice), ()):
+        match = regex.search(choice)
+        if match:
+            return handler(game, match)
+    print("Command not recognized. Type 'help' for info.")
+    return False
+
+@command("atk", pattern=rf"^atk\s+({ENEMY_ID})\s+(-?\d+)$")
+def cmd_atk(game, match):
+    """Attack an enemy"""
+    enemy = game.enemy(match.group(1))
+    if not enemy:
+        return
+    atk = int(match.group(2))
+    if atk >= enemy.template.ac:
+        print("=== Hit! ===")
+    else:
+        print("=== Miss! ===")
 
-    while True:
-        # -- Game startup --
-        while not enemies:
-            enemies = startup_prompt()
-            select.clear()
-            idx = 1
-
-        if not select:
-            for mon in enemies:
-                if not isinstance(mon, Enemy):
-                    continue
-                select[idx] = mon
-                idx += 1
+def parse_ids(text):
+    """Parse enemy IDs like "1,3,5-9" into a list, or None if malformed
 
-        # -- Main loop --
-        print("\n")
-        choice = ""
-        for mon in enemies:
-            if isinstance(mon, Enemy) and (mon.hp > 0 or SHOW_DEAD):
-                how = " ... {}".format(mon.status) if SHOW_HOW else ""
-                speed = " ({})".format(mon.template.speed) if SHOW_SPEED else ""
-                idx = next(k for k,v in select.items() if v == mon)
-                print("{}) {}{}{}".format(
-                    str(idx).rjust(2), mon.nickname, speed, how))
-                if DEBUG:
-                    print("    " + mon.hpinfo)
-            elif not isinstance(mon, Enemy):
-                print(" -) " + mon)
-        choice = input("> ").strip().lower()
-        if not choice:
+    Horde IDs are kept as strings: "g1" for a whole horde, and "g2.4-6"
+    becomes "g2.4", "g2.5", "g2.6"."""
+    uids = list()
+    for part in text.split(","):
+        if re.search(r"^g\d+$", part):
+            uids.append(part)
             continue
+        match = re.search(r"^(g\d+\.)?(\d+)(?:-(\d+))?$", part)
+        if not match:
+            return None
+        first = int(match.group(2))
+        last = int(match.group(3) or first)
+        if match.group(1):
+            uids.extend(f"{match.group(1)}{uid}" for uid in range(first, last + 1))
+        else:
+            uids.extend(range(first, last + 1))
+    return uids
+
+def dmg_flags(properties):
+    """Encode attack properties such as "+$" as bits of DMG_PROPERTIES"""
+    flags = 0
+    for i, prop in enumerate(DMG_PROPERTIES):
+        if prop in properties:
+            flags |= 1 << i
+    return flags
+
+@functools.lru_cache(maxsize=None)
+def match_token(token, conditions=False):
+    """Damage types (and conditions, if asked) abbreviated by token"""
+    types = MOD_TYPES if conditions else DMG_TYPES
+    types_found = [v for v in types if v.startswith(token)]
+
+    # If user provides "poison", it should match "poison",
+    # not create unavoidable ambiguity with "poisoned"
+    if token in types_found:
+        types_found = [token]
+    return tuple(types_found)
+
+def resolve_dmg_type(token):
+    """Return the damage type abbreviated by token, or None"""
+    types_found = match_token(token)
+    if len(types_found) > 1:
+        print(f"Token '{token}' ambiguous: {types_found}")
+        return None
+    elif not types_found:
+        print(f"Could not resolve token: {token}")
+        return None
+    return types_found[0]
+
+def dmg_factors(template):
+    """Return {(damage type, dmg_flags()): multiplier} for template,
+    leaving out multipliers of 1"""
+    factors = dict()
+    mods = template.immune | template.resist | template.weak
+    for dmg_type in DMG_TYPES:
+        # Only physical damage cares how the attack was made
+        if dmg_type in PHYS_DMG:
+            if not mods & PHYS_MODS:
+                continue
+            combos = [flags for flags in range(1 << len(DMG_PROPERTIES))
+                      if not flags & NONMAGICAL_FLAG]
+        elif mods & MOD_BITS[dmg_type]:
+            combos = [0]
+        else:
+            continue
+        for flags in combos:
+            properties = "".join(prop for i, prop in enumerate(DMG_PROPERTIES)
+                                 if flags & 1 << i)
+            factor = dmg_factor(template, dmg_type, properties)
+            if factor != 1:
+                factors[dmg_type, flags] = factor
+    return factors
+
+def dmg_factor(template, dmg_type, properties):
+    """Work out the damage multiplier for template against dmg_type
+
+    Only used to build Monster.factors, use Monster.factor() instead."""
+    dmg_mods = set()
+    if "+" in properties:
+        magical = "magical"
+    elif "-" in properties:
+        magical = "nonmagical"
+    else:
+        magical = "nonmagical" if dmg_type in PHYS_DMG else "magical"
+
+    if template.mod(dmg_type):
+        dmg_mods.add(template.mod(dmg_type))
+    elif dmg_type in PHYS_DMG:
+        if magical and template.mod(magical):
+            dmg_mods.add(template.mod(magical))
+        elif template.mod("nonmagicalnonadamantine") and \
+                "+" not in properties and "@" not in properties:
+            dmg_mods.add(template.mod("nonmagicalnonadamantine"))
+        elif template.mod("nonmagicalnonsilvered") and \
+                "+" not in properties and "$" not in properties:
+            dmg_mods.add(template.mod("nonmagicalnonsilvered"))
+
+    factor = 1
+    for dmg_mod in dmg_mods:
+        factor *= MOD_VALUES[dmg_mod]
+    return factor
+
+def print_effect(factor, nickname):
+    """Say how effective damage scaled by factor was"""
+    if factor == 0:
+        print("It didn't seem to have any effect on {}".format(nickname))
+    elif 0 < factor < 1:
+        print("It didn't seem very effective on {}".format(nickname))
+    elif factor > 1:
+        print("It seemed particularly effective on {}".format(nickname))
+
+def damage(game, uid, enemy, delta, factor=1, quiet=False):
+    """Apply delta damage, scaled by factor, to enemy #uid
+
+    With quiet, nothing is printed."""
+    if not quiet:
+        print_effect(factor, enemy.nickname)
+    if factor == 0:
+        return
+    delta = int(delta * factor)
+
+    enemy.hp -= delta
+    enemy.hp = min(enemy.hp, enemy.template.hp)
+    enemy.refresh_status()
+    if enemy.hp <= 0:
+        enemy.status = "is dead!"
+    if quiet:
+        pass
+    elif enemy.hp <= 0:
+        print("  {} is dead!".format(enemy.nickname))
+    elif delta > 0:
+        print("  {} took {} damage!".format(enemy.nickname, delta))
+    elif delta < 0:
+        print("  {} recovered {} HP!".format(enemy.nickname, -delta))
+    else:
+        print("  {} took...no damage?".format(enemy.nickname))
+    game.journal.record(uid, enemy, game.enemies)
+
+def damage_horde(game, gid, members, delta, factor=1):
+    """Apply delta damage, scaled by factor, to [(uid, member)] of horde
+    gid, summed up on one line"""
+    horde = members[0][1].horde
+    print_effect(factor, horde.nickname)
+    if factor == 0:
+        return
+    alive = sum(1 for uid, member in members if member.hp > 0)
+    for uid, member in members:
+        damage(game, uid, member, delta, factor, quiet=True)
+    died = alive - sum(1 for uid, member in members if member.hp > 0)
+
+    delta = int(delta * factor)
+    if delta > 0:
+        text = "{} took {} damage".format(len(members), delta)
+        if died:
+            text += ", {} died".format(died)
+        text += "!"
+    elif delta < 0:
+        text = "{} recovered {} HP!".format(len(members), -delta)
+    else:
+        text = "{} took...no damage?".format(len(members))
+    print("  {} ({}): {}".format(horde.nickname, gid, text))
+
+def split_hordes(targets):
+    """Split [(uid, enemy, ...)] into those reported one by one and
+    {gid: [...]} of horde members reported together, one line per horde"""
+    singles = list()
+    hordes = dict()
+    for target in targets:
+        uid, enemy = target[:2]
+        if isinstance(enemy, HordeMember) and len(targets) > 1:
+            hordes.setdefault(uid.split(".")[0], []).append(target)
+        else:
+            singles.append(target)
+    return singles, hordes
 
-        if choice == "last" or choice == ".":
-            choice = prev_cmd
-            print("Re-running:", choice)
-        prev_cmd = choice
-
-        print("\n")
+def parse_save(check_str):
+    """Parse saving throw modifiers like "+dex" or "str+1/dex+0"
 
-        basic_pattern = r"^{}\s+(\d+)\s+(-?\d+)"
-        match = re.search(basic_pattern.format("atk") + "$", choice)
-        if match:
-            uid = int(match.group(1))
-            if uid not in select:
-                print("Enemy #{} does not exist!".format(uid))
-                continue
-            enemy = select[uid]
-            atk = int(match.group(2))
-            if atk >= enemy.template.ac:
-                print("=== Hit! ===")
-            else:
-                print("=== Miss! ===")
+    Returns (advantage, [(ability, bonus override)]), or None."""
+    match = re.match(r"([-+])?([-+a-zA-Z/\d]+)?", check_str)
+    if not match or not match.group(2):
+        return None
+    adv = match.group(1)
+    attr = match.group(2)
+
+    abilities = list()
+    # Check if any abilities aren't valid
+    for ability in attr.split("/"):
+        match = re.search(r"^(\w+)([+-]\d+)?", ability)
+        if not match:
+            print("Ability {} not formatted correctly!".format(ability))
             continue
+        trait = match.group(1)
+        override = match.group(2)
+        if trait not in VALID_ABILITIES:
+            print("Ability {} not recognizd!".format(trait))
+            return None
+        abilities.append( (trait, override) )
+    if not abilities:
+        return None
+    return adv, abilities
+
+def roll_save(template, adv, abilities, dc):
+    """Roll a saving throw for template; return True if it succeeds"""
+    scores = list()
+    for trait, override in abilities:
+        if override:
+            scores.append(int(override))
+        else:
+            scores.append(ability_to_mod(template.score(trait)))
 
-        match = re.search(basic_pattern.format("dmg") + "\s*([@$+-]*)(\w*)\s*$", choice)
+    # Process saving throw
+    bonus = max(scores)
+    roll = rng.save.randint(1, 20)
+    reroll = rng.save.randint(1, 20)
+    if DEBUG: print("Rolls: {}, {}".format(roll, reroll))
 
-        if match:
-            uid = int(match.group(1))
-            delta = int(match.group(2))
-            properties = match.group(3)
-            token = match.group(4).lower()
+    if adv == "+":
+        roll = max(roll, reroll)
+    elif adv == "-":
+        roll = min(roll, reroll)
 
-            if uid not in select:
-                print("Enemy #{} does not exist!".format(uid))
-                continue
+    total = roll + bonus
+    if DEBUG:
+        print("{} = {} + {}".format(total, roll, bonus))
+
+    return total >= dc
+
+@command("dmg", pattern=r"^dmg\s+([\dg.,-]+)\s+(-?\d+)\s*([@$+-]*)(\w*)\s*$")
+def cmd_dmg(game, match):
+    """Damage one or more enemies"""
+    targets = game.targets(match.group(1), living_only=True)
+    delta = int(match.group(2))
+    properties = match.group(3)
+    token = match.group(4).lower()
+    if not targets:
+        return
+
+    dmg_type = None
+    if token:
+        dmg_type = resolve_dmg_type(token)
+        if not dmg_type:
+            return
 
-            enemy = select[uid]
-            dmg_mods = set()
+    flags = dmg_flags(properties)
+    singles, hordes = split_hordes(targets)
+    for uid, enemy in singles:
+        damage(game, uid, enemy, delta, enemy.template.factor(dmg_type, flags))
+    for gid, members in hordes.items():
+        factor = members[0][1].template.factor(dmg_type, flags)
+        damage_horde(game, gid, members, delta, factor)
+
+@command("hp", pattern=r"^hp\s+([\dg.,-]+)\s+(-?\d+)$")
+def cmd_hp(game, match):
+    """Set the HP of one or more enemies"""
+    targets = game.targets(match.group(1))
+    hp = int(match.group(2))
+    for uid, enemy in targets:
+        enemy.hp = hp
+        enemy.refresh_status()
+        game.journal.record(uid, enemy, game.enemies)
+    if targets:
+        print("  {} HP set!".format(hp))
+
+@command("check", pattern=rf"^\s*check\s+({ENEMY_ID})\s+(\w+)\s*$")
+def cmd_check(game, match):
+    """Check an enemy's resistances"""
+    enemy = game.enemy(match.group(1))
+    if not enemy:
+        return
+    token = match.group(2)
+    types_found = match_token(token, conditions=True)
+    if len(types_found) > 1:
+        print(f"Token '{token}' ambiguous: {types_found}")
+    elif not types_found:
+        print(f"Could not resolve token: {token}")
+    else:
+        token = types_found[0]
+        res_class = enemy.template.mod(token)
+        if token in DMG_TYPES and res_class:
+            if res_class == MOD_IMMUNE:
+                res_class = "is immune to"
+            elif res_class == MOD_RESIST:
+                res_class = "resists"
+            elif res_class == MOD_VUL:
+                res_class = "is weak to"
+            print(enemy.template.name, res_class, token)
+        elif token in COND_TYPES and res_class:
+            print(f"{enemy.template.name} cannot be {token}")
+        else:
+            print(f"{enemy.template.name} + {token}: No info")
 
-            if token:
-                types_found = [v for v in DMG_TYPES if v.startswith(token)]
+@command("sav", pattern=rf"^({ENEMY_ID})\s+sav\s+([\w+-/]+)\s+(-?\d+)$")
+def cmd_sav(game, match):
+    """Roll a saving throw for an enemy"""
+    enemy = game.enemy(match.group(1))
+    if not enemy:
+        return
+    save = parse_save(match.group(2))
+    dc = int(match.group(3))
+    if not save:
+        return
 
-                # If user provides "poison", it should match "poison",
-                # not create unavoidable ambiguity with "poisoned"
-                if token in types_found:
-                    types_found = [token]
-                if len(types_found) > 1:
-                    print(f"Token '{token}' ambiguous: {types_found}")
-                    continue
-                elif not types_found:
-                    print(f"Could not resolve token: {token}")
-                    continue
+    if roll_save(enemy.template, *save, dc):
+        print("=== Saved! ===")
+    else:
+        print("=== Failed! ===")
+
+@command("sav", pattern=r"^sav\s+([\dg.,-]+)\s+([\w+-/]+)\s+(-?\d+)"
+                        r"(?:\s+(\d+)(?:\s+([@$+-]*)(?!half\b)(\w+))?)?"
+                        r"(\s+half)?\s*$")
+def cmd_mass_sav(game, match):
+    """Roll saving throws for several enemies, optionally dealing
+    damage to those who fail (and half to those who save)"""
+    targets = game.targets(match.group(1), living_only=True)
+    save = parse_save(match.group(2))
+    dc = int(match.group(3))
+    delta = int(match.group(4) or 0)
+    properties = match.group(5) or ""
+    token = (match.group(6) or "").lower()
+    half = bool(match.group(7))
+    if not targets or not save:
+        return
 
-                dmg_type = types_found[0]
-                if "+" in properties:
-                    magical = "magical"
-                elif "-" in properties:
-                    magical = "nonmagical"
-                else:
-                    magical = "nonmagical" if dmg_type in PHYS_DMG else "magical"
-
-                if dmg_type in enemy.template.dmg_mods:
-                    dmg_mods.add(enemy.template.dmg_mods[dmg_type])
-                elif dmg_type in PHYS_DMG:
-                    if magical and magical in enemy.template.dmg_mods:
-                        dmg_mods.add(enemy.template.dmg_mods[magical])
-                    elif "nonmagicalnonadamantine" in enemy.template.dmg_mods and \
-                            "+" not in properties and "@" not in properties:
-                        dmg_mods.add(enemy.template.dmg_mods["nonmagicalnonadamantine"])
-                    elif "nonmagicalnonsilvered" in enemy.template.dmg_mods and \
-                            "+" not in properties and "$" not in properties:
-                        dmg_mods.add(enemy.template.dmg_mods["nonmagicalnonsilvered"])
-
-            factor = 1
-            for dmg_mod in dmg_mods:
-                factor *= MOD_VALUES[dmg_mod]
-            if factor == 0:
-                print("It didn't seem to have any effect")
-                continue
-            elif 0 < factor < 1:
-                print("It didn't seem very effective")
-            elif factor > 1:
-                print("It seemed particularly effective")
-            delta = int(delta * factor)
-
-            enemy.hp -= delta
-            enemy.hp = min(enemy.hp, enemy.template.hp)
-            enemy.refresh_status()
-            if enemy.hp <= 0:
-                print("  {} is dead!".format(enemy.nickname))
-                enemy.status = "is dead!"
-            elif delta > 0:
-                print("  {} took {} damage!".format(enemy.nickname, delta))
-            elif delta < 0:
-                print("  {} recovered {} HP!".format(enemy.nickname, -delta))
-            else:
-                print("  {} took...no damage?".format(enemy.nickname))
-            autosave(enemies)
-            continue
+    dmg_type = None
+    if token:
+        dmg_type = resolve_dmg_type(token)
+        if not dmg_type:
+            return
 
-        match = re.search(basic_pattern.format("hp") + "$", choice)
-        if match:
-            uid = int(match.group(1))
-            if uid not in select:
-                print("Enemy #{} does not exist!".format(uid))
-                continue
-            enemy = select[uid]
-            hp = int(match.group(2))
-            enemy.hp = hp
-            enemy.refresh_status()
-            print("  {} HP set!".format(hp))
-            autosave(enemies)
-            continue
+    # Roll every save before applying any damage
+    results = [(uid, enemy, roll_save(enemy.template, *save, dc))
+               for uid, enemy in targets]
+    flags = dmg_flags(properties)
+    singles, hordes = split_hordes(results)
+    for uid, enemy, saved in singles:
+        print("  {}: {}".format(enemy.nickname, "Saved!" if saved else "Failed!"))
+        amount = delta // 2 if saved and half else 0 if saved else delta
+        if amount:
+            damage(game, uid, enemy, amount, enemy.template.factor(dmg_type, flags))
+    for gid, members in hordes.items():
+        horde = members[0][1].horde
+        failed = [(uid, member) for uid, member, saved in members if not saved]
+        saved = [(uid, member) for uid, member, saved in members if saved]
+        print("  {} ({}): {} saved, {} failed".format(
+            horde.nickname, gid, len(saved), len(failed)))
+        factor = horde.template.factor(dmg_type, flags)
+        if failed and delta:
+            damage_horde(game, gid, failed, delta, factor)
+        if saved and half and delta // 2:
+            damage_horde(game, gid, saved, delta // 2, factor)
+
+@command("mf", pattern=rf"^\s*mf\s+({ENEMY_ID})\s*([mf]?)\s*$")
+def cmd_mf(game, match):
+    """Refresh an enemy's status, optionally changing its gender"""
+    uid = match.group(1)
+    enemy = game.enemy(uid)
+    if not enemy:
+        return
+    new_gender = match.group(2)
+
+    if new_gender:
+        enemy.sex = new_gender
+    enemy.refresh_status()
+    game.journal.record(uid, enemy, game.enemies)
+
+# -- Misc commands --
+
+@command("save", pattern=r"^save(?:\s+(.*))?$")
+def cmd_save(game, match):
+    """Save the game"""
+    filename = match.group(1) or "_save"
+    save_game(filename, game.enemies)
+    if save_path(filename) == save_path(game.journal.name):
+        # The journal was for the old autosave, so start it afresh with
+        # the next change
+        game.journal.base = None
+
+@command("quit")
+def cmd_quit(game, match):
+    """Save and quit"""
+    save_game("_quit", game.enemies)
+    print("Quitting...")
+    return True
+
+@command("bail")
+def cmd_bail(game, match):
+    """Quit without saving"""
+    writer.flush()
+    print("Quitting without saving...")
+    return True
+
+@command("load", pattern=r"^load\s+(.+)$")
+def cmd_load(game, match):
+    """Load a saved game"""
+    filename = match.group(1).strip()
+    if not os.path.isfile(save_path(filename)):
+        print("Cannot load file:", filename)
+        return
+    # Saving reseeds the dice, so do it before they are restored
+    save_game("_load", game.enemies)
+    temp_enemies = load_game(filename)
+    if not temp_enemies:
+        return
+    game.start(temp_enemies)
 
-        match = re.search(r"^\s*check\s+(\d+)\s+(\w+)\s*$", choice)
-        if match:
-            uid = int(match.group(1))
-            if uid not in select:
-                print("Enemy #{} does not exist!".format(uid))
-                continue
-            token = match.group(2)
-            enemy = select[uid]
-            ALL_TYPES = DMG_TYPES + COND_TYPES
-            types_found = [v for v in ALL_TYPES if v.startswith(token)]
-            if token in types_found:
-                types_found = [token]
-            if len(types_found) > 1:
-                print(f"Token '{token}' ambiguous: {types_found}")
-                continue
-            elif not types_found:
-                print(f"Could not resolve token: {token}")
-                continue
-            else:
-                if token in enemy.template.dmg_mods:
-                    res_class = enemy.template.dmg_mods[token]
-                    if res_class == MOD_IMMUNE:
-                        res_class = "is immune to"
-                    elif res_class == MOD_RESIST:
-                        res_class = "resists"
-                    elif res_class == MOD_VUL:
-                        res_class = "is weak to"
-                    print(enemy.template.name, res_class, token)
-                elif token in enemy.template.cond_mods:
-                    print(f"{enemy.template.name} cannot be {token}")
-                else:
-                    print(f"{enemy.template.name} + {token}: No info")
-            continue
+@command("debug")
+def cmd_debug(game, match):
+    """Toggle debug output"""
+    global DEBUG
+    DEBUG = not DEBUG
 
-        match = re.search(r"(\d+)\s+sav\s+([\w+-/]+)\s+(-?\d+)$", choice)
-        if match:
-            uid = int(match.group(1))
-            if uid not in select:
-                print("Enemy #{} does not exist!".format(uid))
-                continue
-            enemy = select[uid]
-            check_str = match.group(2)
-            dc = int(match.group(3))
+@command("how")
+def cmd_how(game, match):
+    """Toggle statuses"""
+    global SHOW_HOW
+    SHOW_HOW = not SHOW_HOW
 
-            # Pull out details of saving throw
-            match = re.match(r"([-+])?([-+a-zA-Z/\d]+)?", check_str)
-            if not match:
-                continue
-            adv = match.group(1)
-            attr = match.group(2)
-
-            abilities = attr.split("/")
-            scores = list()
-            reloop = True
-            # Check if any abilities aren't valid
-            for ability in abilities:
-                match = re.search("^(\w+)([+-]\d+)?", ability)
-                if not match:
-                    print("Ability {} not formatted correctly!".format(ability))
-                    continue
-                trait = match.group(1)
-                override = match.group(2)
-                if trait not in VALID_ABILITIES:
-                    print("Ability {} not recognizd!".format(trait))
-                    break
-                if override:
-                    scores.append(int(override))
-                else:
-                    score = int(getattr(enemy.template, trait))
-                    score = ability_to_mod(score)
-                    scores.append(score)
-            else:
-                reloop = False
-            if reloop:
-                continue
+@command("speed", "spd")
+def cmd_speed(game, match):
+    """Toggle speeds"""
+    global SHOW_SPEED
+    SHOW_SPEED = not SHOW_SPEED
 
-            # Process saving throw
-            bonus = max(scores)
-            roll = random.randint(1, 20)
-            reroll = random.randint(1, 20)
-            if DEBUG: print("Rolls: {}, {}".format(roll, reroll))
+@command("dead")
+def cmd_dead(game, match):
+    """Toggle dead enemies"""
+    global SHOW_DEAD
+    SHOW_DEAD = not SHOW_DEAD
+
+@command("compact")
+def cmd_compact(game, match):
+    """Toggle only drawing changed rows"""
+    global COMPACT
+    COMPACT = not COMPACT
+
+@command("sim", pattern=r"^sim(?:\s+(\d+))?$")
+def cmd_sim(game, match):
+    """Simulate the rest of the battle"""
+    if not levels:
+        print("Party levels are unknown, start a new game to simulate")
+        return
+    trials = int(match.group(1) or 10000)
+    if not trials:
+        return
+    monsters = [(enemy.template, enemy.hp) for enemy in game.select.values()]
+    monsters += [(enemy.template, enemy.hp) for uid, enemy in game.horde_members()]
+    if not any(hp > 0 for mon, hp in monsters):
+        print("No living enemies to simulate")
+        return
+    print_simulation(simulate(monsters, trials, sim_jobs(trials)))
 
-            if adv == "+":
-                roll = max(roll, reroll)
-            elif adv == "-":
-                roll = min(roll, reroll)
+@command("xp")
+def cmd_xp(game, match):
+    """Print encounter XP"""
+    print(exp, "XP")
 
-            total = roll + bonus
+@command("mem")
+def cmd_mem(game, match):
+    """Print memory use"""
+    memory_report(game.enemies)
+
+@command("newgame")
+def cmd_newgame(game, match):
+    """Autosave and set up a new encounter"""
+    game.journal.snapshot(game.enemies)
+    writer.flush()
+    game.start([])
+
+@command("restart")
+def cmd_restart(game, match):
+    """Autosave and heal every enemy"""
+    # _auto keeps the battle as it was until the next change, which
+    # starts a fresh snapshot
+    game.journal.snapshot(game.enemies)
+    game.journal.base = None
+    for uid, enemy in list(game.select.items()) + game.horde_members():
+        enemy.hp = enemy.template.hp
+        enemy.refresh_status()
+
+@command("help")
+def cmd_help(game, match):
+    """Print usage"""
+    print(MENU_USAGE)
+
+def render(game):
+    """Print the battle list with a single write
+
+    In compact mode, only rows that changed since the last call are
+    printed."""
+    rows = list()
+    for mon in game.enemies:
+        if isinstance(mon, Enemy) and (mon.hp > 0 or SHOW_DEAD):
+            how = " ... {}".format(mon.status) if SHOW_HOW else ""
+            speed = " ({})".format(mon.template.speed) if SHOW_SPEED else ""
+            idx = game.uids[mon]
+            row = "{}) {}{}{}\n".format(
+                str(idx).rjust(2), mon.nickname, speed, how)
             if DEBUG:
-                print("{} = {} + {}".format(total, roll, bonus))
+                row += "    " + mon.hpinfo + "\n"
+            rows.append((mon, row))
+        elif isinstance(mon, Horde) and (mon.alive or SHOW_DEAD):
+            speed = " ({})".format(mon.template.speed) if SHOW_SPEED else ""
+            row = "{}) {}{}\n".format(
+                game.uids[mon].rjust(2), mon.summary(), speed)
+            if DEBUG:
+                row += "    " + mon.hpinfo + "\n"
+            rows.append((mon, row))
+        elif not isinstance(mon, (Enemy, Horde)):
+            rows.append((mon, " -) " + mon + "\n"))
 
-            if total >= dc:
-                print("=== Saved! ===")
-            else:
-                print("=== Failed! ===")
+    frame = dict(rows)
+    if COMPACT:
+        rows = [(mon, row) for mon, row in rows if game.frame.get(mon) != row]
+    game.frame = frame
+    sys.stdout.write("\n\n" + "".join(row for mon, row in rows))
+
+def loop_game():
+    """Play the game!"""
+    game = Game()
+    prev_cmd = None
+
+    while True:
+        # -- Game startup --
+        while not game.enemies:
+            game.start(startup_prompt())
+
+        # -- Main loop --
+        render(game)
+        choice = input("> ").strip().lower()
+        if not choice:
             continue
 
-        if re_search(r"^\s*mf\s+(\d+)\s*([mf]?)\s*$", choice):
-            uid = int(re.matchobj.group(1))
-            if uid not in select:
-                print("Enemy #{} does not exist!".format(uid))
+        if choice == "last" or choice == ".":
+            if not prev_cmd:
                 continue
-            enemy = select[uid]
-            new_gender = re.matchobj.group(2)
+            choice = prev_cmd
+            print("Re-running:", choice)
+        prev_cmd = choice
 
-            if new_gender:
-                enemy.sex = new_gender
-            enemy.refresh_status()
-            continue
+        print("\n")
 
-        # -- Misc commands --
-        if choice.startswith("save"):
-            if choice[4:].strip():
-                filename = choice[4:].strip()
-            else:
-                filename = "_save"
-            save_game(filename, enemies)
-        elif choice == "quit":
-            save_game("_quit", enemies)
-            print("Quitting...")
-            return
-        elif choice == "bail":
-            print("Quitting without saving...")
+        if run_command(game, choice):
             return
-        elif choice.startswith("load "):
-            filename = choice[5:].strip()
-            if not os.path.isfile(filename):
-                print("Cannot load file:", filename)
-                continue
-            temp_enemies = load_game(filename)
-            save_game("_load", enemies)
-            enemies = temp_enemies
-            select.clear()
-        elif choice == "debug":
-            DEBUG = not DEBUG
-        elif choice == "how":
-            SHOW_HOW = not SHOW_HOW
-        elif choice in ("speed", "spd"):
-            SHOW_SPEED = not SHOW_SPEED
-        elif choice == "dead":
-            SHOW_DEAD = not SHOW_DEAD
-        elif choice == "xp":
-            print(exp, "XP")
-        elif choice == "newgame":
-            autosave(enemies)
-            enemies.clear()
-            select.clear()
-        elif choice == "restart":
-            autosave(enemies)
-            for enemy in select.values():
-                enemy.hp = enemy.template.hp
-                enemy.refresh_status()
-        elif choice == "help":
-            print(MENU_USAGE)
-        else:
-            print("Command not recognized. Type 'help' for info.")
 
 
 def init_status(filename):
     """Initialize statuses"""
-    global STATUSES
     STATUSES.clear()
     curr = list()
 
@@ -1051,6 +2664,20 @@ def init_status(filename):
     if curr:
         STATUSES.append( (0, curr) )
 
+    # Resolve pronouns for each gender up front
+    for i, (thresh, msgs) in enumerate(STATUSES):
+        variants = list()
+        for idx in (1, 2):
+            resolved = list()
+            for msg in msgs:
+                for group in GENDER:
+                    msg = msg.replace(group[0], group[idx])
+                resolved.append(msg)
+            variants.append(resolved)
+        STATUSES[i] = (thresh, tuple(variants))
+    STATUSES.sort(key=lambda item: item[0])
+    STATUS_FRACS[:] = [thresh for thresh, variants in STATUSES]
+
 
 def settings_loop():
     """Display and print settings"""
@@ -1083,10 +2710,10 @@ def settings_loop():
         elif choice in ("b", "base"):
             choice == "b"
             choice = input("Enter monster (-- to clear): ").lower().strip()
-            if find_monster(templates, choice):
-                base_monster = find_monster(templates, choice)
-            elif choice.startswith("--"):
+            if choice.startswith("--"):
                 base_monster = None
+            else:
+                base_monster = find_monster(choice, fuzzy=True) or base_monster
 
         elif choice in ("r", "return"):
             return
@@ -1162,7 +2789,7 @@ def setup_players(difficulty=True):
         choice = choice.lower()
 
     if choice == "rand":
-        droll = random.randint(1, 20)
+        droll = rng.gen.randint(1, 20)
         if droll <= 4:
             choice = "easy"
         elif droll >= 19:
@@ -1172,6 +2799,18 @@ def setup_players(difficulty=True):
 
     return choice
 
+def init_thresholds(filename):
+    """Initialize XP thresholds"""
+    THRESHOLDS.clear()
+    party_thresholds.cache_clear()
+    with open(filename, "r") as fin:
+        lines = [line.strip() for line in fin.readlines()
+                 if line.strip() and re.match(r"[0-9,]+$", line.strip())]
+
+    for line in lines:
+        line = [int(value) for value in line.split(",")]
+        THRESHOLDS[line[0]] = tuple(line[1:])
+
 def init_names(filename):
     """Initialize player aliases"""
     if not os.path.isfile(filename):
@@ -1204,8 +2843,16 @@ def init_config(filename):
 
 if __name__ == "__main__":
     args = setup_args()
+    if args.seed is not None:
+        seed_streams(args.seed)
+    HORDE_SIZE = args.horde
+    bootstrap_data(data_paths(args.monster_data), args.passphrase_file)
+    if args.batch:
+        run_batch(args)
+        sys.exit(0)
     init_config("settings.txt")
-    templates = init_data(os.path.join("mdata", args.monster_data + ".csv"))
+    init_thresholds("thresholds.csv")
+    templates = init_data(*data_paths(args.monster_data))
     init_status("status.txt")
     init_names("names.txt")
     loop_game()